@@ -0,0 +1,81 @@
+"""Scaling benchmarks of the LMM scans.
+
+Importing ``limix_ext`` imports all of its backends, which need pystan,
+limix, rpy2 (and R), numpy_sugar and h5py besides the install requirements.
+asv therefore runs in the existing environment (``"environment_type":
+"existing"`` in ``asv.conf.json``), where they must be installed along with
+limix_ext itself (``pip install -e .``). Run with ``asv run`` from the
+repository root; results are stored in ``.asv/results``. To compare
+commits, install each one and run ``asv run`` before ``asv compare``.
+"""
+from numpy import asarray, dot, eye, hstack, ones
+from numpy.random import RandomState
+
+from limix_ext.lmm.qtl import normal_scan
+from limix_ext.lmm._core import train_associations
+from limix_ext.lmm._core import train_interact
+
+
+def _data(nsamples, nsnps, nphenotypes=1, ncovariates=1, seed=0):
+    random = RandomState(seed)
+    X = asarray(random.randint(3, size=(nsamples, nsnps)), float)
+    X -= X.mean(0)
+    X /= X.std(0) + 1e-10
+    G = X[:, :min(nsnps, 1000)]
+    K = dot(G, G.T) / G.shape[1] + eye(nsamples)
+    Y = random.randn(nsamples, nphenotypes)
+    C = hstack((ones((nsamples, 1)),
+                random.randn(nsamples, ncovariates - 1)))
+    return (X, Y, C, K)
+
+
+class NormalScan(object):
+    params = ([500, 2000], [1000, 10000], [1, 20])
+    param_names = ['nsamples', 'nsnps', 'ncovariates']
+    timeout = 600
+
+    def setup(self, nsamples, nsnps, ncovariates):
+        (self.X, Y, self.C, self.K) = _data(nsamples, nsnps, 1, ncovariates)
+        self.y = Y[:, 0]
+
+    def time_normal_scan(self, nsamples, nsnps, ncovariates):
+        normal_scan(self.y, self.C, self.X, self.K)
+
+    def peakmem_normal_scan(self, nsamples, nsnps, ncovariates):
+        normal_scan(self.y, self.C, self.X, self.K)
+
+
+class TrainAssociations(object):
+    params = ([500, 2000], [1000, 10000], [1, 10])
+    param_names = ['nsamples', 'nsnps', 'nphenotypes']
+    timeout = 600
+
+    def setup(self, nsamples, nsnps, nphenotypes):
+        (self.X, self.Y, self.C, self.K) = _data(nsamples, nsnps,
+                                                 nphenotypes, 3)
+
+    def time_train_associations(self, nsamples, nsnps, nphenotypes):
+        train_associations(self.X, self.Y, self.K, C=self.C)
+
+    def peakmem_train_associations(self, nsamples, nsnps, nphenotypes):
+        train_associations(self.X, self.Y, self.K, C=self.C)
+
+
+class TrainInteract(object):
+    params = ([500, 2000], [100, 1000])
+    param_names = ['nsamples', 'nsnps']
+    timeout = 600
+
+    def setup(self, nsamples, nsnps):
+        (self.X, Y, C, self.K) = _data(nsamples, nsnps, 1, 3)
+        self.y = Y
+        self.E = C[:, 1:2]
+        self.C = C[:, 2:]
+
+    def time_train_interact(self, nsamples, nsnps):
+        train_interact(self.X, self.y, self.K, interactants=self.E,
+                       covariates=self.C)
+
+    def peakmem_train_interact(self, nsamples, nsnps):
+        train_interact(self.X, self.y, self.K, interactants=self.E,
+                       covariates=self.C)
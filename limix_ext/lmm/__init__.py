@@ -1,2 +1,9 @@
 from . import qtl
 from . import heritability
+from . import permutation
+from . import predict
+from . import cv
+from . import eqtl
+from ._core import enable_eigen_cache, disable_eigen_cache
+from ._core import collect_metrics
+from .null import NullModel
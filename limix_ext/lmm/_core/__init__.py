@@ -1 +1,11 @@
-from ._fastlmm import train_associations
+from ._fastlmm import train_associations, train_associations_blocks
+from ._fastlmm import train_null
+from ._fastlmm import train_interact
+from ._fastlmm import null_state, scan_block
+from ._cache import enable_eigen_cache, disable_eigen_cache
+from ._loco import loco_kinships, loco_eigen
+from ._permutation import permutation_maxstats
+from ._metrics import collect_metrics
+from ._checkpoint import train_associations_resume
+from ._cis import train_cis
+from ._cg import train_associations_cg
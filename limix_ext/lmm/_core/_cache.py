@@ -0,0 +1,129 @@
+from __future__ import division
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as NP
+
+from ..._path import make_sure_path_exists
+
+_cache = None
+
+
+class EigenCache(object):
+    """Disk cache of eigen decompositions keyed by the content of the matrix.
+
+    Every entry is a folder holding ``S.npy`` and ``U.npy``, which are loaded
+    back as read-only memory maps. Entries are evicted in least recently used
+    order once the folder grows beyond ``max_size`` bytes.
+    """
+    def __init__(self, folder, max_size=2**32):
+        self._folder = os.path.abspath(folder)
+        self._max_size = max_size
+        make_sure_path_exists(self._folder)
+
+    @property
+    def folder(self):
+        return self._folder
+
+    def key(self, A, kind='eigh'):
+        A = NP.ascontiguousarray(A, float)
+        h = hashlib.sha1()
+        h.update(('%s:%s' % (kind, str(A.shape))).encode())
+        h.update(A.data)
+        return h.hexdigest()
+
+    def get(self, key):
+        path = os.path.join(self._folder, key)
+        try:
+            S = NP.load(os.path.join(path, 'S.npy'), mmap_mode='r')
+            U = NP.load(os.path.join(path, 'U.npy'), mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            return None
+        os.utime(path, None)
+        return (S, U)
+
+    def put(self, key, S, U):
+        path = os.path.join(self._folder, key)
+        tmp = tempfile.mkdtemp(prefix='.' + key, dir=self._folder)
+        try:
+            NP.save(os.path.join(tmp, 'S.npy'), S)
+            NP.save(os.path.join(tmp, 'U.npy'), U)
+            os.rename(tmp, path)
+        except OSError:
+            # another process has just stored the same entry
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict(keep=key)
+        # None if another process has evicted the entry in the meantime
+        return self.get(key)
+
+    def entries(self):
+        """Returns ``(mtime, size, key)`` of every entry, oldest first."""
+        r = []
+        for key in os.listdir(self._folder):
+            path = os.path.join(self._folder, key)
+            if key.startswith('.') or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f))
+                       for f in os.listdir(path))
+            r.append((os.path.getmtime(path), size, key))
+        return sorted(r)
+
+    def evict(self, keep=None):
+        logger = logging.getLogger(__name__)
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        for (_, size, key) in entries:
+            if total <= self._max_size:
+                break
+            if key == keep:
+                continue
+            logger.debug('Evicting cached decomposition %s.', key)
+            shutil.rmtree(os.path.join(self._folder, key), ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        for (_, _, key) in self.entries():
+            shutil.rmtree(os.path.join(self._folder, key), ignore_errors=True)
+
+
+def enable_eigen_cache(folder, max_size=2**32):
+    """Cache the kinship eigen decompositions of every LMM entry point on disk.
+
+    Parameters
+    ----------
+    folder : str
+        Cache folder; it is created if necessary and can be shared between
+        processes.
+    max_size : int
+        Maximum size in bytes of the cache; least recently used entries are
+        evicted beyond it.
+    """
+    global _cache
+    _cache = EigenCache(folder, max_size)
+    return _cache
+
+
+def disable_eigen_cache():
+    global _cache
+    _cache = None
+
+
+def cached(A, kind, decompose):
+    """Returns ``decompose(A)`` from the active cache, computing it if needed."""
+    if _cache is None:
+        return decompose(A)
+    key = _cache.key(A, kind)
+    r = _cache.get(key)
+    if r is None:
+        logger = logging.getLogger(__name__)
+        logger.info('Eigen decomposition not cached; computing it')
+        S, U = decompose(A)
+        r = _cache.put(key, S, U)
+        if r is None:
+            # evicted by another process before it could be loaded back
+            r = (S, U)
+    return r
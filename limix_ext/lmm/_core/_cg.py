@@ -0,0 +1,168 @@
+from __future__ import division
+
+import logging
+from itertools import chain
+
+import numpy as NP
+import scipy.stats as st
+from numpy.random import RandomState
+
+from ._metrics import staged
+
+
+class GenotypeKinship(object):
+    """kinship scale * G G.T / m applied through genotype products only
+
+    G (n, m) holds standardized genotypes; K itself is never formed.
+    """
+    def __init__(self, G, scale=None):
+        self.G = G
+        self.m = G.shape[1]
+        if scale is None:
+            scale = self.gower_factor()
+        self.scale = scale
+
+    def dot(self, V):
+        return self.scale * NP.dot(self.G, NP.dot(self.G.T, V)) / self.m
+
+    def trace(self):
+        return self.scale * NP.einsum('ij,ij->', self.G, self.G) / self.m
+
+    def gower_factor(self):
+        """Gower factor of G G.T / m from trace and total sum (see util)"""
+        n = self.G.shape[0]
+        s = self.G.sum(0)
+        tr = NP.einsum('ij,ij->', self.G, self.G) / self.m
+        return (n - 1) / (tr - NP.dot(s, s) / self.m / n)
+
+
+@staged('cg')
+def cg_solve(matvec, B, tol=1e-8, maxiter=1000):
+    """solve A X = B for symmetric positive definite A given by matvec
+
+    The columns of B are solved simultaneously by conjugate gradients, so
+    every iteration costs a single (n, k) matvec.
+    """
+    B = NP.asarray(B, float)
+    squeeze = B.ndim == 1
+    B = B.reshape((B.shape[0], -1))
+    X = NP.zeros(B.shape)
+    R = B.copy()
+    P = R.copy()
+    rs = (R * R).sum(0)
+    stop = (tol * tol) * (B * B).sum(0)
+    for _ in range(maxiter):
+        if NP.all(rs <= stop):
+            break
+        AP = matvec(P)
+        pAp = (P * AP).sum(0)
+        alpha = NP.where(pAp > 0, rs / NP.where(pAp > 0, pAp, 1), 0.)
+        X += alpha * P
+        R -= alpha * AP
+        rs_new = (R * R).sum(0)
+        P = R + NP.where(rs > 0, rs_new / NP.where(rs > 0, rs, 1), 0.) * P
+        rs = rs_new
+    else:
+        logging.getLogger(__name__).warning(
+            'Conjugate gradients did not converge in %d iterations.', maxiter)
+    return X[:, 0] if squeeze else X
+
+
+def _project(C, CCi, V):
+    """M V with M = I - C (C'C)^-1 C'"""
+    return V - NP.dot(C, NP.dot(CCi, NP.dot(C.T, V)))
+
+
+@staged('delta')
+def moment_variance(y, C, kinship, nprobes=30, random=None):
+    """genetic and noise variances of y by the method of moments
+
+    Haseman-Elston / RHE regression after projecting out the covariates C:
+    the moment equations involve tr(MK) and tr(MKMK); the latter is
+    estimated from nprobes Rademacher vectors (Hutchinson), so only
+    products with the kinship are needed.
+    returns sigg2, sige2
+    """
+    if random is None:
+        random = RandomState()
+    n, c = C.shape
+    CCi = NP.linalg.pinv(NP.dot(C.T, C))
+    My = _project(C, CCi, y)
+    Z = random.randint(2, size=(n, nprobes)) * 2. - 1.
+    W = _project(C, CCi, kinship.dot(_project(C, CCi, Z)))
+    trMKMK = (W * W).sum() / nprobes
+    CKC = NP.dot(C.T, kinship.dot(C))
+    trMK = kinship.trace() - NP.trace(NP.dot(CCi, CKC))
+    A = NP.array([[trMKMK, trMK], [trMK, n - c]])
+    b = NP.array([NP.dot(My, kinship.dot(My)), NP.dot(My, My)])
+    sigg2, sige2 = NP.linalg.solve(A, b)
+    if sigg2 < 0:
+        sigg2, sige2 = 0., b[1] / (n - c)
+    sige2 = max(sige2, 1e-4 * b[1] / (n - c))
+    return sigg2, sige2
+
+
+def train_associations_cg(blocks, y, G, C=None, ncalibration=30, nprobes=30,
+                          dtype=float, tol=1e-8, maxiter=1000, random=0):
+    """calibrated score tests of SNP blocks without forming the kinship
+
+    The kinship is the Gower normalized G G.T / m of the standardized
+    genotypes G. The variance components are fitted by the method of
+    moments (moment_variance) and V^-1 [y, C] is solved by conjugate
+    gradients. The score statistic of a SNP x is (x'Py)^2 / x'Px;
+    as in BOLT-LMM, x'Px is approximated by gamma x'Mx, with gamma the
+    mean ratio of the two over ncalibration random SNPs of the first block
+    solved exactly.
+    random (a seed or RandomState) draws the trace probes and the calibration
+    SNPs, so a fixed seed makes the scan reproducible
+    yields (stats, pvals), each shaped (1, s_block), for every block
+    """
+    logger = logging.getLogger(__name__)
+    if not isinstance(random, RandomState):
+        random = RandomState(random)
+    n = y.shape[0]
+    y = NP.asarray(y, float).ravel()
+    if C is None:
+        C = NP.ones((n, 1))
+    kinship = GenotypeKinship(G)
+    CCi = NP.linalg.pinv(NP.dot(C.T, C))
+
+    logger.info('Variance components')
+    sigg2, sige2 = moment_variance(y, C, kinship, nprobes, random)
+    logger.debug('sigg2=%e, sige2=%e', sigg2, sige2)
+
+    def matvec(V):
+        return sigg2 * kinship.dot(V) + sige2 * V
+
+    def P(B):
+        ViB = cg_solve(matvec, B, tol, maxiter)
+        return ViB - NP.dot(ViC, NP.dot(A, NP.dot(ViC.T, B)))
+
+    logger.info('Conjugate gradients')
+    Vi = cg_solve(matvec, NP.column_stack((y, C)), tol, maxiter)
+    ViC = Vi[:, 1:]
+    A = NP.linalg.pinv(NP.dot(C.T, ViC))
+    Py = Vi[:, 0] - NP.dot(ViC, NP.dot(A, NP.dot(C.T, Vi[:, 0])))
+
+    blocks = iter(blocks)
+    first = NP.asarray(next(blocks), float)
+    idx = random.choice(first.shape[1], min(ncalibration, first.shape[1]),
+                        replace=False)
+    Xc = first[:, idx]
+    xPx = (Xc * P(Xc)).sum(0)
+    xMx = (Xc * _project(C, CCi, Xc)).sum(0)
+    ok = xMx > 1e-10 * (Xc * Xc).sum(0)
+    gamma = NP.mean(xPx[ok] / xMx[ok]) if ok.any() else 1.
+    logger.debug('Calibration factor %e', gamma)
+
+    Py = Py.astype(dtype)
+    for X in chain([first], blocks):
+        X = NP.asarray(X, dtype)
+        num = NP.dot(X.T, Py)
+        XC = NP.dot(X.T, C.astype(dtype))
+        xMx = NP.einsum('ij,ij->j', X, X) - NP.einsum('ij,jk,ik->i', XC,
+                                                        CCi, XC)
+        stats = NP.zeros(X.shape[1])
+        ok = xMx > 1e-10 * NP.einsum('ij,ij->j', X, X)
+        stats[ok] = num[ok] ** 2 / (gamma * xMx[ok])
+        yield stats[NP.newaxis, :], st.chi2.sf(stats, 1)[NP.newaxis, :]
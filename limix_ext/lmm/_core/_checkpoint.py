@@ -0,0 +1,131 @@
+from __future__ import division
+
+import hashlib
+import logging
+import os
+import tempfile
+
+import numpy as NP
+
+from ..._path import make_sure_path_exists, temp_folder
+from . import _fastlmm
+from ._fastlmm import null_state, scan_block, _init_worker
+from ._parallel import dump_shared, imap_ordered
+
+
+def _update(h, value):
+    if value is None:
+        h.update(b'None')
+    elif hasattr(value, 'shape'):
+        A = NP.ascontiguousarray(value)
+        h.update(('%s:%s' % (A.dtype.str, str(A.shape))).encode())
+        h.update(A.data)
+    elif isinstance(value, type):
+        h.update(NP.dtype(value).str.encode())
+    else:
+        h.update(repr(value).encode())
+
+
+def fingerprint(*args, **kwargs):
+    """Hash of the content of arrays and of the value of other arguments."""
+    h = hashlib.sha1()
+    for value in args:
+        _update(h, value)
+    for key in sorted(kwargs):
+        h.update(key.encode())
+        _update(h, kwargs[key])
+    return h.hexdigest()
+
+
+def save_atomic(path, **arrays):
+    """Writes arrays to the .npz file path, complete or not at all."""
+    (fd, tmp) = tempfile.mkstemp(prefix='.', suffix='.npz',
+                                 dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            NP.savez(f, **arrays)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # Windows does not replace existing files
+            os.remove(path)
+            os.rename(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _load(path):
+    with NP.load(path) as f:
+        return dict((k, f[k] if f[k].ndim > 0 else f[k].item())
+                    for k in f.files)
+
+
+def _resume_block(item, state):
+    """loads the results of a block from its file, or tests and stores them"""
+    (path, key, X) = item
+    if os.path.exists(path):
+        try:
+            f = _load(path)
+            if f['key'] == key:
+                return tuple(f['r%d' % i] for i in range(len(f) - 1))
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+    r = scan_block(X, state)
+    save_atomic(path, key=key,
+                **dict(('r%d' % i, v) for (i, v) in enumerate(r)))
+    return r
+
+
+def _resume_shared(item):
+    """_resume_block against the null model bound by _init_worker"""
+    return _resume_block(item, _fastlmm._shared)
+
+
+def train_associations_resume(folder, blocks, Y, K, nprocs=1, **kwargs):
+    """train_associations_blocks that checkpoints to folder.
+
+    The results are kept in a subfolder named after the fingerprint of
+    ``Y``, ``K`` and the other arguments. It holds the fitted null state and
+    one file per finished block, each written atomically. The file of a
+    block also records the fingerprint of the block itself. A rerun with the
+    same inputs loads the null state and every unchanged finished block
+    instead of recomputing them.
+    """
+    logger = logging.getLogger(__name__)
+    folder = os.path.join(folder, fingerprint(Y, K, **kwargs))
+    make_sure_path_exists(folder)
+
+    path = os.path.join(folder, 'null.npz')
+    if os.path.exists(path):
+        logger.info('Loading the null state from %s', path)
+        state = _load(path)
+    else:
+        arrays, params = null_state(Y, K, **kwargs)
+        state = dict(arrays)
+        state.update(params)
+        save_atomic(path, **state)
+
+    names = ('S', 'U', 'UY', 'Ucovariate')
+    arrays = dict((k, state.pop(k)) for k in names)
+    params = state
+    null = (params['ldelta0'], params['sigg20'], params['beta0'])
+
+    def items():
+        for (i, X) in enumerate(blocks):
+            path = os.path.join(folder, 'block%08d.npz' % i)
+            yield (path, fingerprint(X), X)
+
+    if nprocs > 1:
+        with temp_folder() as shared:
+            dump_shared(shared, arrays)
+            for r in imap_ordered(_resume_shared, items(), nprocs,
+                                  _init_worker, (shared, params)):
+                yield r[:2] + null + r[2:]
+        return
+    state = dict(arrays)
+    state.update(params)
+    for item in items():
+        r = _resume_block(item, state)
+        yield r[:2] + null + r[2:]
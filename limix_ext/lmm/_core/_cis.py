@@ -0,0 +1,61 @@
+from __future__ import division
+
+import logging
+
+import numpy as NP
+import scipy.stats as st
+
+from ._fastlmm import _rotate_data, fit_null, rotate, nLLeval_snps
+
+
+def window_bounds(snp_key, pheno_key, window):
+    """sorted SNP order and the [lo, hi) range of it within window of every phenotype
+    keys are positions comparable across chromosomes (see lmm.eqtl)
+    """
+    order = NP.argsort(snp_key, kind='mergesort')
+    skey = NP.asarray(snp_key)[order]
+    lo = NP.searchsorted(skey, NP.asarray(pheno_key) - window, 'left')
+    hi = NP.searchsorted(skey, NP.asarray(pheno_key) + window, 'right')
+    return order, lo, hi
+
+
+def train_cis(X,Y,K,snp_key,pheno_key,window,C=None,chunk_size=1000,dtype=float,scale=1.0,numintervals0=100,ldeltamin0=-5.0,ldeltamax0=5.0):
+    """ test every phenotype in Y (n, p) against the SNPs of X within window of it
+    K is decomposed and the null model of every phenotype is fitted once.
+    The phenotypes are visited in order of position while the rotated SNPs
+    of the current windows are kept in a sliding cache: it is extended by
+    rotations of chunk_size sorted SNPs at a time and trimmed below the
+    window, so overlapping windows share their U.T X columns.
+    yields (phenotype, snps, stats, pvals) for every phenotype
+    """
+    logger = logging.getLogger(__name__)
+    n=Y.shape[0]
+    nsnps=X.shape[1]
+    S,U,UY,Ucovariate=_rotate_data(Y,K,C,False,None,scale)
+    LL0,ldelta0,sigg20,beta0=fit_null(UY,Ucovariate,S,numintervals0,ldeltamin0,ldeltamax0,nsamples=n)
+    U=U.astype(dtype,copy=False)
+    order,lo,hi=window_bounds(snp_key,pheno_key,window)
+
+    # the cache holds the rotated sorted SNPs [c_lo, c_hi); both window
+    # bounds are non-decreasing along the sorted phenotypes
+    c_lo=c_hi=0
+    cache=NP.empty((U.shape[1],0),dtype)
+    for j in NP.argsort(pheno_key,kind='mergesort'):
+        if lo[j]>c_lo:
+            cache=cache[:,min(lo[j],c_hi)-c_lo:]
+            c_lo=min(lo[j],c_hi)
+            if c_hi<lo[j]:
+                c_lo=c_hi=lo[j]
+        if hi[j]>c_hi:
+            end=min(max(hi[j],c_hi+chunk_size),nsnps)
+            logger.debug('Rotating sorted SNPs %d to %d.', c_hi, end)
+            UX=rotate(U,NP.asarray(X[:,order[c_hi:end]],dtype))
+            cache=NP.hstack((cache,UX))
+            c_hi=end
+        if hi[j]<=lo[j]:
+            yield j, NP.empty(0,int), NP.empty(0), NP.empty(0)
+            continue
+        UXw=cache[:,lo[j]-c_lo:hi[j]-c_lo]
+        nLL=nLLeval_snps(ldelta0[j],UY[:,j],UXw,Ucovariate,S,nsamples=n)
+        stats=2*(-nLL-LL0[j])
+        yield j, order[lo[j]:hi[j]], stats, st.chi2.sf(stats,1)
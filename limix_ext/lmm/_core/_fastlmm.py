@@ -6,15 +6,21 @@ import scipy.linalg as LA
 import scipy.optimize as OPT
 import scipy.stats as st
 
+from ..._path import temp_folder
+from ._cache import cached
+from ._metrics import staged, disable_metrics
+from ._parallel import dump_shared, load_shared, imap_ordered
+
 # log of 2pi
 L2pi = 1.8378770664093453
-#@profile
-def nLLeval(ldelta,UY,UX,S,MLparams=False):
+def nLLeval(ldelta,UY,UX,S,MLparams=False,nsamples=None):
     """evaluate the negative LL of a LMM with kernel USU.T"""
     delta=SP.exp(ldelta);
     n,d=UX.shape;
+    if nsamples is not None:
+        n=nsamples;
     Sdi=S+delta;
-    ldet=SP.sum(NP.log(Sdi));
+    ldet=SP.sum(NP.log(Sdi))+(n-S.shape[0])*ldelta;
     Sdi=1.0/Sdi;
     XSdi=UX.T*SP.tile(Sdi,(d,1));
     XSX=SP.dot(XSdi,UX);
@@ -30,18 +36,149 @@ def nLLeval(ldelta,UY,UX,S,MLparams=False):
     else:
         return nLL;
 
-#@profile
-def optdelta(UY,UX,S,ldeltanull=None,numintervals=100,ldeltamin=-10.0,ldeltamax=10.0):
+def nLLeval_grid(ldeltagrid,UY,UX,S,MLparams=False,nsamples=None):
+    """evaluate the negative LL of a LMM with kernel USU.T for every log(delta) in ldeltagrid
+
+    All grid points share a single pass over the eigenvalues: the weighted
+    Gram matrices are obtained as one matrix product of the (g,n) weights
+    against the per-sample outer products of the design.
+    """
+    ldeltagrid=NP.atleast_1d(ldeltagrid)
+    delta=NP.exp(ldeltagrid)
+    n,d=UX.shape
+    if nsamples is not None:
+        n=nsamples
+    Sd=S[NP.newaxis,:]+delta[:,NP.newaxis]
+    ldet=NP.log(Sd).sum(1)+(n-S.shape[0])*ldeltagrid
+    Sdi=1.0/Sd
+    XX=(UX[:,:,NP.newaxis]*UX[:,NP.newaxis,:]).reshape(-1,d*d)
+    XSX=NP.dot(Sdi,XX).reshape(-1,d,d)
+    XSY=NP.dot(Sdi,UX*UY[:,NP.newaxis])
+    YSY=NP.dot(Sdi,UY*UY)
+    beta=NP.einsum('gij,gj->gi',NP.linalg.pinv(XSX),XSY)
+    sigg2=(YSY-NP.einsum('gi,gi->g',XSY,beta))/n
+    nLL=0.5*(n*L2pi+ldet+n+n*NP.log(sigg2))
+    if MLparams:
+        return nLL, beta, sigg2
+    else:
+        return nLL
+
+@staged('snps')
+def nLLeval_snps(ldelta,UY,UX,Ucovariate,S,MLparams=False,nsamples=None):
+    """evaluate the negative LL of the models [UX[:,snp], Ucovariate] for all SNPs at a fixed delta
+
+    EMMA-X closed form: the weighted covariate Gram matrix is inverted once and
+    every SNP only enters through its Schur complement r=x'Px, with P the
+    weighted projection off the covariates, so that the per-SNP effect,
+    variance and likelihood follow from a few dot products.
+    The SNP products are computed in the precision of UX (e.g. float32); the
+    covariate-only terms are always carried out in float64.
+    SNPs in the span of the covariates (r~0) get a null effect.
+    If MLparams, the effects, sigg2 and r (the SNP information, from which the
+    standard errors sqrt(sigg2/r) follow) are returned as well
+    """
+    delta=NP.exp(ldelta)
+    n,s=UX.shape
+    if nsamples is not None:
+        n=nsamples
+    c=Ucovariate.shape[1]
+    Sd=S+delta
+    ldet=NP.log(Sd).sum()+(n-S.shape[0])*ldelta
+    Sdi=1.0/Sd
+    CSdi=Ucovariate*Sdi[:,NP.newaxis]
+    CSCi=NP.linalg.pinv(NP.dot(CSdi.T,Ucovariate))
+    CSY=NP.dot(CSdi.T,UY)
+    beta0=NP.dot(CSCi,CSY)
+    RSS0=NP.dot(UY*Sdi,UY)-NP.dot(CSY,beta0)
+    XSdi=UX*Sdi.astype(UX.dtype)[:,NP.newaxis]
+    XSX=NP.einsum('ij,ij->j',XSdi,UX)
+    XSC=NP.dot(XSdi.T,Ucovariate.astype(UX.dtype))
+    XSY=NP.dot(XSdi.T,UY.astype(UX.dtype))
+    XSCi=NP.dot(XSC,CSCi)
+    r=XSX-NP.einsum('ij,ij->i',XSCi,XSC)
+    xPy=XSY-NP.dot(XSC,beta0)
+    ok=r>1e-10*NP.abs(XSX)
+    betax=NP.zeros(s)
+    betax[ok]=xPy[ok]/r[ok]
+    sigg2=(RSS0-betax*xPy)/n
+    nLL=0.5*(n*L2pi+ldet+n+n*NP.log(sigg2))
+    if MLparams:
+        beta=NP.empty((s,c+1))
+        beta[:,0]=betax
+        beta[:,1:]=beta0-XSCi*betax[:,NP.newaxis]
+        return nLL, beta, sigg2, r
+    else:
+        return nLL
+
+@staged('delta')
+def nLLeval_null_phenos(ldeltagrid,UY,Ucovariate,S,nsamples=None):
+    """evaluate the negative LL of the covariate-only models of every phenotype in UY (n,b) over ldeltagrid
+
+    The weighted covariate Gram matrices only depend on delta, so they are
+    shared by all phenotypes; the phenotype terms are (g,n)x(n,b) products.
+    returns nLL (g,b)
+    """
+    ldeltagrid=NP.atleast_1d(ldeltagrid)
+    delta=NP.exp(ldeltagrid)
+    n,c=Ucovariate.shape
+    if nsamples is not None:
+        n=nsamples
+    Sd=S[NP.newaxis,:]+delta[:,NP.newaxis]
+    ldet=NP.log(Sd).sum(1)+(n-S.shape[0])*ldeltagrid
+    Sdi=1.0/Sd
+    CC=(Ucovariate[:,:,NP.newaxis]*Ucovariate[:,NP.newaxis,:]).reshape(-1,c*c)
+    CSCi=NP.linalg.pinv(NP.dot(Sdi,CC).reshape(-1,c,c))
+    CSY=NP.stack([NP.dot(Sdi,UY*Ucovariate[:,k:k+1]) for k in range(c)],-1)
+    YSY=NP.dot(Sdi,UY*UY)
+    RSS=YSY-NP.einsum('gbi,gij,gbj->gb',CSY,CSCi,CSY)
+    return 0.5*(n*L2pi+ldet[:,NP.newaxis]+n+n*NP.log(RSS/n))
+
+@staged('snps')
+def nLLeval_snps_phenos(ldelta,UY,UX,Ucovariate,S,nsamples=None):
+    """evaluate the negative LL of the models [UX[:,snp], Ucovariate] for all SNPs and all phenotypes in UY (n,b)
+
+    Every phenotype has its own delta (b,), so the weighted SNP products are
+    formed as (b,n)x(n,s) matrix products: one for the SNP norms, one for
+    the phenotypes and one per covariate. The per-SNP solves follow
+    nLLeval_snps.
+    returns nLL (b,s)
+    """
+    ldelta=NP.asarray(ldelta,float)
+    delta=NP.exp(ldelta)
+    n,s=UX.shape
+    if nsamples is not None:
+        n=nsamples
+    c=Ucovariate.shape[1]
+    Sd=S[NP.newaxis,:]+delta[:,NP.newaxis]
+    ldet=NP.log(Sd).sum(1)+(n-S.shape[0])*ldelta
+    Sdi=1.0/Sd
+    CC=(Ucovariate[:,:,NP.newaxis]*Ucovariate[:,NP.newaxis,:]).reshape(-1,c*c)
+    CSCi=NP.linalg.pinv(NP.dot(Sdi,CC).reshape(-1,c,c))
+    YSdi=UY.T*Sdi
+    CSY=NP.dot(YSdi,Ucovariate)
+    beta0=NP.einsum('bij,bj->bi',CSCi,CSY)
+    RSS0=NP.einsum('bi,ib->b',YSdi,UY)-NP.einsum('bi,bi->b',CSY,beta0)
+    Sdi=Sdi.astype(UX.dtype)
+    XSX=NP.dot(Sdi,UX*UX)
+    XSY=NP.dot(YSdi.astype(UX.dtype),UX)
+    XSC=NP.stack([NP.dot(Sdi,UX*Ucovariate[:,k:k+1].astype(UX.dtype)) for k in range(c)],-1)
+    r=XSX-NP.einsum('bsi,bij,bsj->bs',XSC,CSCi,XSC)
+    xPy=XSY-NP.einsum('bsi,bi->bs',XSC,beta0)
+    ok=r>1e-10*NP.abs(XSX)
+    RSS=NP.repeat(RSS0[:,NP.newaxis],s,1)
+    RSS[ok]-=xPy[ok]**2/r[ok]
+    return 0.5*(n*L2pi+ldet[:,NP.newaxis]+n+n*NP.log(RSS/n))
+
+@staged('delta')
+def optdelta(UY,UX,S,ldeltanull=None,numintervals=100,ldeltamin=-10.0,ldeltamax=10.0,nsamples=None):
     """find the optimal delta"""
-    if ldeltanull==None:
-        nllgrid=SP.ones(numintervals+1)*SP.inf;
-        ldeltagrid=SP.arange(numintervals+1)/(numintervals*1.0)*(ldeltamax-ldeltamin)+ldeltamin;
-        nllmin=SP.inf;
-        for i in SP.arange(numintervals+1):
-            nllgrid[i]=nLLeval(ldeltagrid[i],UY,UX,S);
-            if nllgrid[i]<nllmin:
-                nllmin=nllgrid[i];
-                ldeltaopt_glob=ldeltagrid[i];
+    if ldeltanull is None:
+        ldeltagrid=NP.arange(numintervals+1)/(numintervals*1.0)*(ldeltamax-ldeltamin)+ldeltamin
+        nllgrid=nLLeval_grid(ldeltagrid,UY,UX,S,nsamples=nsamples)
+        nllgrid[NP.isnan(nllgrid)]=NP.inf
+        i=NP.argmin(nllgrid)
+        nllmin=nllgrid[i]
+        ldeltaopt_glob=ldeltagrid[i]
         foundMin=False
         for i in SP.arange(numintervals-1)+1:
             continue
@@ -49,7 +186,7 @@ def optdelta(UY,UX,S,ldeltanull=None,numintervals=100,ldeltamin=-10.0,ldeltamax=
             #carry out brent optimization within the interval
             if ((nllgrid[i-1]-nllgrid[i])>ee) and ((nllgrid[i+1]-nllgrid[i])>1E-8):
                 foundMin = True
-                ldeltaopt,nllopt,iter,funcalls = OPT.brent(nLLeval,(UY,UX,S),(ldeltagrid[i-1],ldeltagrid[i],ldeltagrid[i+1]),full_output=True);
+                ldeltaopt,nllopt,iter,funcalls = OPT.brent(nLLeval,(UY,UX,S,False,nsamples),(ldeltagrid[i-1],ldeltagrid[i],ldeltagrid[i+1]),full_output=True);
                 if nllopt<nllmin:
                     nllmin=nllopt;
                     ldeltaopt_glob=ldeltaopt;
@@ -57,23 +194,59 @@ def optdelta(UY,UX,S,ldeltanull=None,numintervals=100,ldeltamin=-10.0,ldeltamax=
         ldeltaopt_glob=ldeltanull;
     return ldeltaopt_glob;
 
-def estimateBeta(X,Y,K,C=None,addBiasTerm=False,numintervals0=100,ldeltamin0=-5.0,ldeltamax0=5.0):
+@staged('eigen')
+def eigen(K=None,G=None,scale=1.0):
+    """eigen decomposition of the kinship scale*K
+
+    If the background genotypes G (K=G G.T) are given instead, the thin SVD of
+    G is used (low-rank FaST-LMM): the k eigenvalues are followed by n zeros
+    accounting for the complement rows stacked by rotate.
+    Decompositions are read from the disk cache set up by enable_eigen_cache.
+    The scale (e.g. the Gower factor) is applied to the eigenvalues only, so
+    K is neither copied nor modified.
+    """
+    if G is None:
+        S,U=cached(K,'eigh',LA.eigh)
+    else:
+        S,U=cached(G,'svd',_svd)
+    return S*scale,U
+
+def _svd(G):
+    U,s,_=LA.svd(G,full_matrices=False)
+    if U.shape[1]<U.shape[0]:
+        return NP.concatenate((s*s,NP.zeros(U.shape[0]))),U
+    return s*s,U
+
+@staged('rotate')
+def rotate(U,A):
+    """rotate A to the eigenbasis U
+
+    For a low-rank U (n,k) the projection onto the complement (I-UU.T)A is
+    stacked below U.T A.
+    """
+    UA=NP.dot(U.T,A)
+    if U.shape[1]<U.shape[0]:
+        return NP.vstack((UA,A-NP.dot(U,UA)))
+    return UA
+
+def estimateBeta(X,Y,K,C=None,addBiasTerm=False,numintervals0=100,ldeltamin0=-5.0,ldeltamax0=5.0,G=None):
     """ compute all pvalues
     If numintervalsAlt==0 use EMMA-X trick (keep delta fixed over alternative models)
+    If G is given, K=G G.T is never formed and the low-rank likelihood is used
     """
     n,s=X.shape;
     n_pheno=Y.shape[1];
-    S,U=LA.eigh(K);
-    UY=SP.dot(U.T,Y);
-    UX=SP.dot(U.T,X);
-    if (C==None):
-        Ucovariate=SP.dot(U.T,SP.ones([n,1]));
+    S,U=eigen(K,G);
+    UY=rotate(U,Y);
+    UX=rotate(U,X);
+    if (C is None):
+        Ucovariate=rotate(U,SP.ones([n,1]));
     else:
         if (addBiasTerm):
             C_=SP.concatenate((C,SP.ones([n,1])),axis=1)
-            Ucovariate=SP.dot(U.T,C_);
+            Ucovariate=rotate(U,C_);
         else:
-            Ucovariate=SP.dot(U.T,C);
+            Ucovariate=rotate(U,C);
     n_covar=Ucovariate.shape[1];
     beta = SP.empty((n_pheno,s,n_covar+1));
     LL=SP.ones((n_pheno,s))*(-SP.inf);
@@ -82,95 +255,394 @@ def estimateBeta(X,Y,K,C=None,addBiasTerm=False,numintervals0=100,ldeltamin0=-5.
     pval=SP.ones((n_pheno,s))*(-SP.inf);
     for phen in SP.arange(n_pheno):
         UY_=UY[:,phen];
-        ldelta[phen]=optdelta(UY_,Ucovariate,S,ldeltanull=None,numintervals=numintervals0,ldeltamin=ldeltamin0,ldeltamax=ldeltamax0);
-        for snp in SP.arange(s):
-            UX_=SP.hstack((UX[:,snp:snp+1],Ucovariate));
-            nLL_, beta_, sigg2_=nLLeval(ldelta[phen,snp],UY_,UX_,S,MLparams=True);
-            beta[phen,snp,:]=beta_;
-            sigg2[phen,snp]=sigg2_;
-            LL[phen,snp]=-nLL_;
+        ldelta[phen]=optdelta(UY_,Ucovariate,S,ldeltanull=None,numintervals=numintervals0,ldeltamin=ldeltamin0,ldeltamax=ldeltamax0,nsamples=n);
+        nLL_, beta_, sigg2_, _=nLLeval_snps(ldelta[phen,0],UY_,UX,Ucovariate,S,MLparams=True,nsamples=n)
+        beta[phen]=beta_
+        sigg2[phen]=sigg2_
+        LL[phen]=-nLL_
     return beta, ldelta
 
-#@profile
-def train_associations(X,Y,K,C=None,addBiasTerm=False,numintervalsAlt=0,ldeltaminAlt=-1.0,ldeltamaxAlt=1.0,numintervals0=100,ldeltamin0=-5.0,ldeltamax0=5.0, calc_pval=True):
-    """ compute all pvalues
-    If numintervalsAlt==0 use EMMA-X trick (keep delta fixed over alternative models)
+def _rotate_data(Y,K,C,addBiasTerm,G,scale=1.0,eig=None):
+    """eigen decomposition and rotation of the phenotypes and covariates
+    eig is an optional precomputed decomposition (S,U) of the kinship
     """
-    logger = logging.getLogger(__name__)
-    n,s=X.shape;
-    n_pheno=Y.shape[1];
-    logger.info('Eigen decomposition')
-    S,U=LA.eigh(K);
-    UY=SP.dot(U.T,Y);
-    UX=SP.dot(U.T,X);
+    n=Y.shape[0]
+    if eig is None:
+        S,U=eigen(K,G,scale)
+    else:
+        S,U=eig[0]*scale,eig[1]
+    UY=rotate(U,Y)
     if (C is None):
-        Ucovariate=SP.dot(U.T,SP.ones([n,1]));
+        Ucovariate=rotate(U,SP.ones([n,1]))
     else:
         if (addBiasTerm):
             C_=SP.concatenate((C,SP.ones([n,1])),axis=1)
-            Ucovariate=SP.dot(U.T,C_);
+            Ucovariate=rotate(U,C_)
         else:
-            Ucovariate=SP.dot(U.T,C);
-    n_covar=Ucovariate.shape[1];
-    beta = SP.empty((n_pheno,s,n_covar+1));
-    beta0 = SP.empty((n_pheno,n_covar));
-    LL=SP.ones((n_pheno,s))*(-SP.inf);
-    LL0=SP.ones((n_pheno))*(-SP.inf);
-    ldelta=SP.empty((n_pheno,s));
-    ldelta0=SP.empty(n_pheno);
-    sigg2=SP.empty((n_pheno,s));
-    sigg20=SP.empty((n_pheno));
-    pval=SP.ones((n_pheno,s))*(-SP.inf);
-    for phen in SP.arange(n_pheno):
-        UY_=UY[:,phen];
+            Ucovariate=rotate(U,C)
+    return S,U,UY,Ucovariate
+
+def fit_null(UY,Ucovariate,S,numintervals0=100,ldeltamin0=-5.0,ldeltamax0=5.0,nsamples=None):
+    """fit the null model (covariates only) of every phenotype in UY
+    returns LL0, ldelta0, sigg20, beta0
+    """
+    logger = logging.getLogger(__name__)
+    n_pheno=UY.shape[1]
+    n_covar=Ucovariate.shape[1]
+    beta0=NP.empty((n_pheno,n_covar))
+    LL0=NP.ones(n_pheno)*(-NP.inf)
+    ldelta0=NP.empty(n_pheno)
+    sigg20=NP.empty(n_pheno)
+    for phen in range(n_pheno):
+        UY_=UY[:,phen]
         logger.info('Delta optimization')
-        ldelta0[phen]=optdelta(UY_,Ucovariate,S,ldeltanull=None,numintervals=numintervals0,ldeltamin=ldeltamin0,ldeltamax=ldeltamax0);
-        logger.debug('log(delta) was fitted to %e.', ldelta0)
+        ldelta0[phen]=optdelta(UY_,Ucovariate,S,ldeltanull=None,numintervals=numintervals0,ldeltamin=ldeltamin0,ldeltamax=ldeltamax0,nsamples=nsamples)
+        logger.debug('log(delta) was fitted to %e.', ldelta0[phen])
         logger.info('nLL evaluation')
-        nLL0_, beta0_, sigg20_=nLLeval(ldelta0[phen],UY_,Ucovariate,S,MLparams=True);
-        beta0[phen,:]=beta0_;
-        sigg20[phen]=sigg20_;
-        LL0[phen]=-nLL0_;
+        nLL0_, beta0_, sigg20_=nLLeval(ldelta0[phen],UY_,Ucovariate,S,MLparams=True,nsamples=nsamples)
+        beta0[phen,:]=beta0_
+        sigg20[phen]=sigg20_
+        LL0[phen]=-nLL0_
+    return LL0, ldelta0, sigg20, beta0
+
+def train_null(Y,K,C=None,addBiasTerm=False,numintervals0=100,ldeltamin0=-5.0,ldeltamax0=5.0,G=None,scale=1.0):
+    """ fit the null model (covariates only) of every phenotype in Y (n, p)
+    All phenotypes share a single decomposition of scale*K and no SNP is
+    rotated nor tested.
+    returns LL0, ldelta0, sigg20, beta0
+    """
+    logger = logging.getLogger(__name__)
+    logger.info('Eigen decomposition')
+    S,U,UY,Ucovariate=_rotate_data(Y,K,C,addBiasTerm,G,scale)
+    return fit_null(UY,Ucovariate,S,numintervals0,ldeltamin0,ldeltamax0,nsamples=Y.shape[0])
+
+def scan_associations(UX,UY,Ucovariate,S,ldelta0,numintervalsAlt=0,ldeltaminAlt=-1.0,ldeltamaxAlt=1.0,nsamples=None):
+    """fit the alternative models [UX[:,snp], Ucovariate] of every phenotype in UY
+    If numintervalsAlt==0 use EMMA-X trick (keep delta fixed to ldelta0)
+    returns LL, ldelta, sigg2, beta and the SNP information x'Px (n_pheno, s)
+    computed along the way, or None if delta is refitted per SNP (see
+    snp_information)
+    """
+    logger = logging.getLogger(__name__)
+    s=UX.shape[1]
+    n_pheno=UY.shape[1]
+    n_covar=Ucovariate.shape[1]
+    beta=NP.empty((n_pheno,s,n_covar+1))
+    LL=NP.ones((n_pheno,s))*(-NP.inf)
+    ldelta=NP.empty((n_pheno,s))
+    sigg2=NP.empty((n_pheno,s))
+    info=NP.empty((n_pheno,s)) if numintervalsAlt==0 else None
+    for phen in range(n_pheno):
+        UY_=UY[:,phen]
+        if numintervalsAlt==0: #EMMA-X trick #fast version, no refitting of detla
+            logger.info('Evaluating all candidates for alternative model')
+            ldelta[phen,:]=ldelta0[phen]
+            nLL_, beta_, sigg2_, info[phen]=nLLeval_snps(ldelta0[phen],UY_,UX,Ucovariate,S,MLparams=True,nsamples=nsamples)
+            beta[phen]=beta_
+            sigg2[phen]=sigg2_
+            LL[phen]=-nLL_
+            continue
         logger.info('Running over each candidate for alternative model')
-        for snp in SP.arange(s):
+        for snp in range(s):
             UX_=SP.hstack((UX[:,snp:snp+1],Ucovariate));
-            if numintervalsAlt==0: #EMMA-X trick #fast version, no refitting of detla
-                ldelta[phen,snp]=ldelta0[phen];
-            else: #fit delta
-                ldelta[phen,snp]=optdelta(UY_,UX_,S,ldeltanull=None,numintervals=numintervalsAlt,ldeltamin=ldelta0[phen]+ldeltaminAlt,ldeltamax=ldelta0[phen]+ldeltamaxAlt);
-            nLL_, beta_, sigg2_=nLLeval(ldelta[phen,snp],UY_,UX_,S,MLparams=True);
+            #fit delta
+            ldelta[phen,snp]=optdelta(UY_,UX_,S,ldeltanull=None,numintervals=numintervalsAlt,ldeltamin=ldelta0[phen]+ldeltaminAlt,ldeltamax=ldelta0[phen]+ldeltamaxAlt,nsamples=nsamples);
+            nLL_, beta_, sigg2_=nLLeval(ldelta[phen,snp],UY_,UX_,S,MLparams=True,nsamples=nsamples);
             beta[phen,snp,:]=beta_;
             sigg2[phen,snp]=sigg2_;
             LL[phen,snp]=-nLL_;
-    #reshaping of LL0
-    LL0 = LL0[:,SP.newaxis]
-    lods = LL-LL0
+    return LL, ldelta, sigg2, beta, info
+
+@staged('score')
+def score_associations(UX,UY,Ucovariate,S,ldelta0,beta0,sigg20,MLparams=False):
+    """score statistics of the SNPs in UX against the null models of every phenotype in UY
+    Only the null model is needed: the numerators of all SNPs follow from a
+    single product of UX with the weighted null residuals, and the
+    denominators from the covariate-projected weighted SNP norms.
+    returns stats (n_pheno, s), asymptotically chi2 with 1 dof
+    If MLparams, the one-step effect estimates and their standard errors are
+    returned as well
+    """
+    s=UX.shape[1]
+    n_pheno=UY.shape[1]
+    stats=NP.empty((n_pheno,s))
+    beta=NP.zeros((n_pheno,s))
+    se=NP.ones((n_pheno,s))*NP.inf
+    for phen in range(n_pheno):
+        Sdi=1.0/(S+NP.exp(ldelta0[phen]))
+        res=(UY[:,phen]-NP.dot(Ucovariate,beta0[phen]))*Sdi
+        XSdi=UX*Sdi.astype(UX.dtype)[:,NP.newaxis]
+        XSC=NP.dot(XSdi.T,Ucovariate.astype(UX.dtype))
+        CSC=NP.dot(Ucovariate.T*Sdi,Ucovariate)
+        XSX=NP.einsum('ij,ij->j',XSdi,UX)
+        XPX=XSX-NP.einsum('ij,ij->i',NP.dot(XSC,NP.linalg.pinv(CSC)),XSC)
+        XPY=NP.dot(UX.T,res.astype(UX.dtype))
+        ok=XPX>1e-10*NP.abs(XSX)
+        stats[phen]=0.0
+        stats[phen,ok]=XPY[ok]**2/(sigg20[phen]*XPX[ok])
+        beta[phen,ok]=XPY[ok]/XPX[ok]
+        se[phen,ok]=NP.sqrt(sigg20[phen]/XPX[ok])
+    if MLparams:
+        return stats, beta, se
+    return stats
+
+def snp_information(UX,Ucovariate,S,ldelta):
+    """Schur complements x'Px of the SNPs in UX given their log(delta) (n_pheno, s)
+    P is the weighted projection off the covariates; the SNPs of a phenotype
+    that share a delta (EMMA-X) are evaluated together.
+    The standard error of an effect estimate is sqrt(sigg2/x'Px).
+    Only needed if delta is refitted per SNP: otherwise scan_associations
+    returns the x'Px computed by nLLeval_snps.
+    """
+    r=NP.empty(ldelta.shape)
+    for phen in range(ldelta.shape[0]):
+        ldeltas=NP.unique(ldelta[phen])
+        for ld in ldeltas:
+            if len(ldeltas)==1:
+                i=slice(None)
+            else:
+                i=NP.where(ldelta[phen]==ld)[0]
+            Sdi=1.0/(S+NP.exp(ld))
+            XSdi=UX[:,i]*Sdi.astype(UX.dtype)[:,NP.newaxis]
+            XSC=NP.dot(XSdi.T,Ucovariate.astype(UX.dtype))
+            CSC=NP.dot(Ucovariate.T*Sdi,Ucovariate)
+            XSX=NP.einsum('ij,ij->j',XSdi,UX[:,i])
+            r[phen,i]=XSX-NP.einsum('ij,ij->i',NP.dot(XSC,NP.linalg.pinv(CSC)),XSC)
+    return r
+
+def _se(UX,d,ldelta,sigg2,r=None):
+    if r is None:
+        r=snp_information(UX,d['Ucovariate'],d['S'],ldelta)
+    se=NP.ones(r.shape)*NP.inf
+    ok=r>0
+    se[ok]=NP.sqrt(sigg2[ok]/r[ok])
+    return se
+
+def _lrt(LL,LL0,ldelta,calc_pval):
+    lods = LL-LL0[:,NP.newaxis]
     if calc_pval:
         arg2 = st.chi2.sf(2*(lods),1)
     else:
         arg2 = ldelta
+    return 2*lods, arg2
+
+def _check_method(method):
+    if method not in ('lrt','score'):
+        raise ValueError("Unknown method: %s; use 'lrt' or 'score'." % method)
+
+def train_associations(X,Y,K,C=None,addBiasTerm=False,numintervalsAlt=0,ldeltaminAlt=-1.0,ldeltamaxAlt=1.0,numintervals0=100,ldeltamin0=-5.0,ldeltamax0=5.0, calc_pval=True, G=None, nprocs=1, chunk_size=1000, dtype=float, scale=1.0, method='lrt', score_threshold=1e-4):
+    """ compute all pvalues
+    If numintervalsAlt==0 use EMMA-X trick (keep delta fixed over alternative models)
+    If G is given, K=G G.T is never formed and the low-rank likelihood is used
+    If nprocs>1 blocks of chunk_size SNPs are scanned in parallel
+    dtype sets the precision of the SNP rotation and tests (see nLLeval_snps)
+    The kinship is scale*K; the scale is applied to its eigenvalues
+    If method=='score', SNPs are first screened with score tests against the
+    null model and only those with p-value below score_threshold are refitted
+    for the exact likelihood ratio test (statistics of the others are scores)
+    """
+    _check_method(method)
+    if nprocs>1 or method!='lrt':
+        blocks=(X[:,i:i+chunk_size] for i in range(0,X.shape[1],chunk_size))
+        r=list(train_associations_blocks(blocks,Y,K,C,addBiasTerm,numintervalsAlt,ldeltaminAlt,ldeltamaxAlt,numintervals0,ldeltamin0,ldeltamax0,calc_pval,G,nprocs,dtype,scale,method,score_threshold))
+        stats=NP.concatenate([ri[0] for ri in r],axis=1)
+        arg2=NP.concatenate([ri[1] for ri in r],axis=1)
+        return (stats, arg2)+tuple(r[0][2:])
+    logger = logging.getLogger(__name__)
+    n=X.shape[0]
+    logger.info('Eigen decomposition')
+    S,U,UY,Ucovariate=_rotate_data(Y,K,C,addBiasTerm,G,scale)
+    UX=rotate(U.astype(dtype,copy=False),NP.asarray(X,dtype))
+    LL0,ldelta0,sigg20,beta0=fit_null(UY,Ucovariate,S,numintervals0,ldeltamin0,ldeltamax0,nsamples=n)
+    LL,ldelta,sigg2,beta,_=scan_associations(UX,UY,Ucovariate,S,ldelta0,numintervalsAlt,ldeltaminAlt,ldeltamaxAlt,nsamples=n)
+    stats,arg2=_lrt(LL,LL0,ldelta,calc_pval)
     #return LL0, LL, pval, ldelta0, sigg20, beta0, ldelta, sigg2, beta
-    return 2*lods, arg2, ldelta0, sigg20, beta0
+    return stats, arg2, ldelta0, sigg20, beta0
+
+def train_associations_blocks(blocks,Y,K,C=None,addBiasTerm=False,numintervalsAlt=0,ldeltaminAlt=-1.0,ldeltamaxAlt=1.0,numintervals0=100,ldeltamin0=-5.0,ldeltamax0=5.0, calc_pval=True, G=None, nprocs=1, dtype=float, scale=1.0, method='lrt', score_threshold=1e-4, eig=None, records=False):
+    """ train_associations over an iterable of SNP blocks (n, s_block)
+    The null model is fitted once; each block is then rotated, tested and its
+    (stats, pvals, ldelta0, sigg20, beta0) yielded before the next one is read,
+    so memory is bounded by the block size.
+    If nprocs>1 the blocks are scanned by a process pool that memory-maps
+    S, U, UY and Ucovariate from a temporary folder; results stay in order.
+    The null model is fitted in float64; dtype sets the precision of the SNP
+    rotation and tests (float32 halves their memory traffic).
+    The kinship is scale*K; the scale is applied to its eigenvalues.
+    method and score_threshold select the two-stage score test screening
+    (see train_associations).
+    If eig=(S,U) is given, it is used instead of decomposing K (e.g. LOCO).
+    If records, the SNP effects, their standard errors and the log(delta) of
+    every SNP (n_pheno, s_block) are yielded after beta0 (see scan_block).
+    """
+    arrays,params=null_state(Y,K,C,addBiasTerm,numintervalsAlt,ldeltaminAlt,ldeltamaxAlt,numintervals0,ldeltamin0,ldeltamax0,calc_pval,G,dtype,scale,method,score_threshold,eig,records)
+    null=params['ldelta0'],params['sigg20'],params['beta0']
+    if nprocs>1:
+        with temp_folder() as folder:
+            dump_shared(folder,arrays)
+            for r in imap_ordered(_scan_block,blocks,nprocs,_init_worker,(folder,params)):
+                yield r[:2]+null+r[2:]
+        return
+    state=dict(arrays)
+    state.update(params)
+    for X in blocks:
+        r=scan_block(X,state)
+        yield r[:2]+null+r[2:]
+
+def null_state(Y,K,C=None,addBiasTerm=False,numintervalsAlt=0,ldeltaminAlt=-1.0,ldeltamaxAlt=1.0,numintervals0=100,ldeltamin0=-5.0,ldeltamax0=5.0, calc_pval=True, G=None, dtype=float, scale=1.0, method='lrt', score_threshold=1e-4, eig=None, records=False):
+    """ decompose the kinship, rotate Y and C and fit the null model once
+    returns the arrays (S, U, UY, Ucovariate) and the parameters
+    (null model and scan options) that scan_block tests SNP blocks against
+    """
+    _check_method(method)
+    logger = logging.getLogger(__name__)
+    n=Y.shape[0]
+    logger.info('Eigen decomposition')
+    S,U,UY,Ucovariate=_rotate_data(Y,K,C,addBiasTerm,G,scale,eig)
+    LL0,ldelta0,sigg20,beta0=fit_null(UY,Ucovariate,S,numintervals0,ldeltamin0,ldeltamax0,nsamples=n)
+    U=U.astype(dtype,copy=False)
+    arrays=dict(S=S,U=U,UY=UY,Ucovariate=Ucovariate)
+    params=dict(LL0=LL0,ldelta0=ldelta0,sigg20=sigg20,beta0=beta0,method=method,score_threshold=score_threshold,numintervalsAlt=numintervalsAlt,ldeltaminAlt=ldeltaminAlt,ldeltamaxAlt=ldeltamaxAlt,nsamples=n,calc_pval=calc_pval,records=records)
+    return arrays, params
+
+_shared=None
+
+def _init_worker(folder,params):
+    global _shared
+    # stages are only recorded by the parent
+    disable_metrics()
+    _shared=dict(load_shared(folder))
+    _shared.update(params)
+
+def _scan_block(X):
+    """rotate and test one SNP block against the null model of a pool worker
+
+    only workers bind _shared, so serial scans never share their state
+    """
+    return scan_block(X,_shared)
+
+def scan_block(X,d):
+    """rotate and test one SNP block against the null model state d (see null_state)
+    returns stats, arg2 and, if d['records'], the SNP effects, their standard
+    errors and log(delta) (n_pheno, s_block)
+    """
+    UX=rotate(d['U'],NP.asarray(X,d['U'].dtype))
+    if d['method']=='score':
+        return _score_block(UX,d)
+    LL,ldelta,sigg2,beta,info=scan_associations(UX,d['UY'],d['Ucovariate'],d['S'],d['ldelta0'],d['numintervalsAlt'],d['ldeltaminAlt'],d['ldeltamaxAlt'],nsamples=d['nsamples'])
+    stats,arg2=_lrt(LL,d['LL0'],ldelta,d['calc_pval'])
+    if d.get('records',False):
+        return stats, arg2, beta[...,0], _se(UX,d,ldelta,sigg2,info), ldelta
+    return stats, arg2
 
-def train_interact(X,Y,K,interactants=None,covariates=None,addBiasTerm=True,numintervalsAlt=0,ldeltaminAlt=-1.0,ldeltamaxAlt=1.0,numintervals0=10,ldeltamin0=-5.0,ldeltamax0=5.0):
+def _score_block(UX,d):
+    """score test screening of one rotated block; candidates get the exact LRT
+    effects of the others are the one-step estimates of the score test
+    """
+    stats,beta,se=score_associations(UX,d['UY'],d['Ucovariate'],d['S'],d['ldelta0'],d['beta0'],d['sigg20'],MLparams=True)
+    pvals=st.chi2.sf(stats,1)
+    ldelta=NP.repeat(d['ldelta0'][:,NP.newaxis],UX.shape[1],1)
+    cand=NP.where((pvals<d['score_threshold']).any(0))[0]
+    if len(cand)>0:
+        LL,ldelta[:,cand],sigg2,beta_,info=scan_associations(UX[:,cand],d['UY'],d['Ucovariate'],d['S'],d['ldelta0'],d['numintervalsAlt'],d['ldeltaminAlt'],d['ldeltamaxAlt'],nsamples=d['nsamples'])
+        stats[:,cand],pvals[:,cand]=_lrt(LL,d['LL0'],ldelta[:,cand],True)
+        if d.get('records',False):
+            beta[:,cand]=beta_[...,0]
+            se[:,cand]=_se(UX[:,cand],d,ldelta[:,cand],sigg2,info)
+    arg2=pvals if d['calc_pval'] else ldelta
+    if d.get('records',False):
+        return stats, arg2, beta, se, ldelta
+    return stats, arg2
+
+@staged('designs')
+def nLLeval_designs(ldelta,UY,UD,S,MLparams=False,nsamples=None):
+    """evaluate the negative LL of a batch of models with designs UD (b,n,d)
+
+    ldelta is either shared by all models or given per model (b,).
+    """
+    ldelta=NP.asarray(ldelta,float)
+    delta=NP.exp(ldelta)
+    b,n,d=UD.shape
+    if nsamples is not None:
+        n=nsamples
+    Sd=S+delta[...,NP.newaxis]
+    ldet=NP.log(Sd).sum(-1)+(n-S.shape[0])*ldelta
+    Sdi=1.0/Sd
+    DSdi=(UD*Sdi[...,:,NP.newaxis]).transpose(0,2,1)
+    XSX=NP.matmul(DSdi,UD)
+    XSY=NP.dot(DSdi,UY)
+    YSY=NP.dot(Sdi,UY*UY)
+    beta=NP.einsum('bij,bj->bi',NP.linalg.pinv(XSX),XSY)
+    sigg2=(YSY-NP.einsum('bi,bi->b',XSY,beta))/n
+    nLL=0.5*(n*L2pi+ldet+n+n*NP.log(sigg2))
+    if MLparams:
+        return nLL, beta, sigg2
+    else:
+        return nLL
+
+def optdelta_designs(UY,UD,S,ldeltagrid,nsamples=None):
+    """find the optimal delta of every model in the batch UD (b,n,d)
+
+    ldeltagrid is a (g,) grid shared by all models or a (g,b) grid per model;
+    returns ldelta, nLL, beta, sigg2 at the per-model grid minimum.
+    """
+    b,_,d=UD.shape
+    ldelta=NP.empty(b)
+    nLL=NP.ones(b)*NP.inf
+    beta=NP.zeros((b,d))
+    sigg2=NP.empty(b)
+    for ldelta_ in ldeltagrid:
+        nLL_,beta_,sigg2_=nLLeval_designs(ldelta_,UY,UD,S,MLparams=True,nsamples=nsamples)
+        ok=nLL_<nLL
+        ldelta[ok]=NP.broadcast_to(ldelta_,(b,))[ok]
+        nLL[ok]=nLL_[ok]
+        beta[ok]=beta_[ok]
+        sigg2[ok]=sigg2_[ok]
+    return ldelta, nLL, beta, sigg2
+
+def _interact_designs(U,X,interactants,Uinteractants,Ucovariate):
+    """background and foreground designs of a block of SNPs X (n,b), shaped (b,n,d)
+
+    background: SNP, interactants, covariates
+    foreground: SNP x interactants, background
+    All interaction columns of the block are rotated by a single product.
+    """
+    n,b=X.shape
+    m=interactants.shape[1]
+    c=Ucovariate.shape[1]
+    UX=rotate(U,X)
+    Xi=(X[:,:,NP.newaxis]*interactants[:,NP.newaxis,:]).reshape(n,b*m)
+    UXi=rotate(U,Xi).reshape(-1,b,m)
+    UD=NP.empty((b,UX.shape[0],2*m+1+c))
+    UD[:,:,:m]=UXi.transpose(1,0,2)
+    UD[:,:,m]=UX.T
+    UD[:,:,m+1:2*m+1]=Uinteractants
+    UD[:,:,2*m+1:]=Ucovariate
+    return UD[:,:,m:], UD
+
+def train_interact(X,Y,K,interactants=None,covariates=None,addBiasTerm=True,numintervalsAlt=0,ldeltaminAlt=-1.0,ldeltamaxAlt=1.0,numintervals0=10,ldeltamin0=-5.0,ldeltamax0=5.0,G=None,chunk_size=100):
     """ compute all pvalues
     If numintervalsAlt==0 use EMMA-X trick (keep delta fixed over alternative models)
-    difference to previous model: Ux and Ucovariate are recomputed for every SNP
+    If G is given, K=G G.T is never formed and the low-rank likelihood is used
+    SNPs are processed in blocks of chunk_size, whose background and foreground
+    models are evaluated together over the delta grid
+    every block holds its rotated designs UD and their weighted copy in
+    nLLeval_designs, 2*8*chunk_size*n*(2m+1+c) bytes for m interactants and c
+    covariates (about 64 MB per 100 SNPs at n=10000 and m=c=1)
     """
     n,s=X.shape;
     n_pheno=Y.shape[1];
-    S,U=LA.eigh(K);
-    UY=SP.dot(U.T,Y);
-    UX=SP.dot(U.T,X);
-    if (covariates==None):
+    S,U=eigen(K,G);
+    UY=rotate(U,Y);
+    if (covariates is None):
         covariates = SP.ones([n,0])
     if (addBiasTerm):
         covariates=SP.concatenate((covariates,SP.ones([n,1])),axis=1)
     #Ucovariates
-    Ucovariate=SP.dot(U.T,covariates);
+    Ucovariate=rotate(U,covariates);
 
     #Uinteractants
-    Uinteractants = SP.dot(U.T,interactants)
+    Uinteractants = rotate(U,interactants)
     n_covar=covariates.shape[1]
     n_inter=interactants.shape[1]
     #weights
@@ -184,62 +656,56 @@ def train_interact(X,Y,K,interactants=None,covariates=None,addBiasTerm=True,numi
     ldelta0=SP.empty([n_pheno,s]);
     sigg2=SP.empty((n_pheno,s));
     sigg20=SP.empty((n_pheno,s));
-    pval=SP.ones((n_pheno,s))*(-SP.inf);
-    for snp in SP.arange(s):
-        #loop through all SNPs
-        #1. snp-specific backgroud model SNP effect + covaraites + interactants
-        Ucovariates_=SP.hstack((UX[:,snp:snp+1],Uinteractants,Ucovariate))
-        #2. snp-specific foreground model
-        #interactions
-        Xi_ = X[:,snp:snp+1]*interactants
-        #transform
-        UXi_ = SP.dot(U.T,Xi_)
-        #stack: interactions, interactants (main) SNPs (main) covariates (if any)
-        UX_  = SP.hstack((UXi_,Ucovariates_))
-        for phen in SP.arange(n_pheno):
+    ldeltagrid0=NP.arange(numintervals0+1)/(numintervals0*1.0)*(ldeltamax0-ldeltamin0)+ldeltamin0
+    if numintervalsAlt>0:
+        ldeltaoffsets=NP.arange(numintervalsAlt+1)/(numintervalsAlt*1.0)*(ldeltamaxAlt-ldeltaminAlt)+ldeltaminAlt
+    for i in range(0,s,chunk_size):
+        #loop through blocks of SNPs
+        blk=slice(i,i+chunk_size)
+        #1. snp-specific backgroud models SNP effect + covaraites + interactants
+        #2. snp-specific foreground models: interactions + background
+        UD0,UD=_interact_designs(U,X[:,blk],interactants,Uinteractants,Ucovariate)
+        for phen in range(n_pheno):
             #loop through phenoptypes
             #get transformed Y
             UY_=UY[:,phen]
-            #1. fit background model
-            ldelta0[phen,snp]=optdelta(UY_,Ucovariates_,S,ldeltanull=None,numintervals=numintervals0,ldeltamin=ldeltamin0,ldeltamax=ldeltamax0);
-            nLL0_, beta0_, sigg20_=nLLeval(ldelta0[phen,snp],UY_,Ucovariates_,S,MLparams=True);
-            beta0[phen,snp,:]=beta0_;
-            sigg20[phen,snp]=sigg20_;
-            LL0[phen,snp]=-nLL0_;
-
-            #2. fit foreground model
+            #1. fit background models
+            ldelta0[phen,blk],nLL0_,beta0[phen,blk],sigg20[phen,blk]=optdelta_designs(UY_,UD0,S,ldeltagrid0,nsamples=n)
+            LL0[phen,blk]=-nLL0_
+
+            #2. fit foreground models
             if numintervalsAlt==0: #EMMA-X trick #fast version, no refitting of detla
-                ldelta[phen,snp]=ldelta0[phen,snp]
+                ldelta[phen,blk]=ldelta0[phen,blk]
+                nLL_,beta[phen,blk],sigg2[phen,blk]=nLLeval_designs(ldelta0[phen,blk],UY_,UD,S,MLparams=True,nsamples=n)
             else: #fit delta
-                ldelta[phen,snp]=optdelta(UY_,UX_,S,ldeltanull=None,numintervals=numintervalsAlt,ldeltamin=ldelta0[phen,snp]+ldeltaminAlt,ldeltamax=ldelta0[phen,snp]+ldeltamaxAlt);
-            nLL_, beta_, sigg2_=nLLeval(ldelta[phen,snp],UY_,UX_,S,MLparams=True);
-            beta[phen,snp,:]=beta_;
-            sigg2[phen,snp]=sigg2_;
-            LL[phen,snp]=-nLL_;
+                ldeltagrid=ldelta0[phen,blk][NP.newaxis,:]+ldeltaoffsets[:,NP.newaxis]
+                ldelta[phen,blk],nLL_,beta[phen,blk],sigg2[phen,blk]=optdelta_designs(UY_,UD,S,ldeltagrid,nsamples=n)
+            LL[phen,blk]=-nLL_
     pval = st.chi2.sf(2*(LL-LL0),1)
     return LL0, LL, pval, ldelta0, sigg20, beta0, ldelta, sigg2, beta
 
 
 
-def train_interactX(X,Y,K,interactants=None,covariates=None,addBiasTerm=True,numintervalsAlt=0,ldeltaminAlt=-1.0,ldeltamaxAlt=1.0,numintervals0=10,ldeltamin0=-5.0,ldeltamax0=5.0):
+def train_interactX(X,Y,K,interactants=None,covariates=None,addBiasTerm=True,numintervalsAlt=0,ldeltaminAlt=-1.0,ldeltamaxAlt=1.0,numintervals0=10,ldeltamin0=-5.0,ldeltamax0=5.0,G=None,chunk_size=100):
     """ compute all pvalues
     If numintervalsAlt==0 use EMMA-X trick (keep delta fixed over alternative models)
-    difference to previous model: Ux and Ucovariate are recomputed for every SNP
+    If G is given, K=G G.T is never formed and the low-rank likelihood is used
+    SNPs are processed in blocks of chunk_size, with the memory cost per block
+    of train_interact
     """
     n,s=X.shape;
     n_pheno=Y.shape[1];
-    S,U=LA.eigh(K);
-    UY=SP.dot(U.T,Y);
-    UX=SP.dot(U.T,X);
-    if (covariates==None):
+    S,U=eigen(K,G);
+    UY=rotate(U,Y);
+    if (covariates is None):
         covariates = SP.ones([n,0])
     if (addBiasTerm):
         covariates=SP.concatenate((covariates,SP.ones([n,1])),axis=1)
     #Ucovariates
-    Ucovariate=SP.dot(U.T,covariates);
+    Ucovariate=rotate(U,covariates);
 
     #Uinteractants
-    Uinteractants = SP.dot(U.T,interactants)
+    Uinteractants = rotate(U,interactants)
     n_covar=covariates.shape[1]
     n_inter=interactants.shape[1]
     #weights
@@ -253,79 +719,107 @@ def train_interactX(X,Y,K,interactants=None,covariates=None,addBiasTerm=True,num
     ldelta0=SP.empty([n_pheno,s]);
     sigg2=SP.empty((n_pheno,s));
     sigg20=SP.empty((n_pheno,s));
-    pval=SP.ones((n_pheno,s))*(-SP.inf);
     #0. fit 0 model on phenotypes and covariates alone
-    for phen in SP.arange(n_pheno):
-        #fit if phen is visited the first time
-        #loop through phenoptypes
+    for phen in range(n_pheno):
         #get transformed Y
         UY_=UY[:,phen]
         #1. fit background model to set delta
-        ldelta0[phen,:]=optdelta(UY_,Ucovariate,S,ldeltanull=None,numintervals=numintervals0,ldeltamin=ldeltamin0,ldeltamax=ldeltamax0);
-
-    #1. loop through all snps
-    for snp in SP.arange(s):
-        #loop through all SNPs
-        #1. snp-specific backgroud model SNP effect + covaraites + interactants
-        Ucovariates_=SP.hstack((UX[:,snp:snp+1],Uinteractants,Ucovariate))
-        #2. snp-specific foreground model
-        #interactions
-        Xi_ = X[:,snp:snp+1]*interactants
-        #transform
-        UXi_ = SP.dot(U.T,Xi_)
-        #stack: interactions, interactants (main) SNPs (main) covariates (if any)
-        UX_  = SP.hstack((UXi_,Ucovariates_))
-
-        for phen in SP.arange(n_pheno):
+        ldelta0[phen,:]=optdelta(UY_,Ucovariate,S,ldeltanull=None,numintervals=numintervals0,ldeltamin=ldeltamin0,ldeltamax=ldeltamax0,nsamples=n);
+    #emmaX trick
+    ldelta[:]=ldelta0
+
+    #1. loop through blocks of snps
+    for i in range(0,s,chunk_size):
+        blk=slice(i,i+chunk_size)
+        UD0,UD=_interact_designs(U,X[:,blk],interactants,Uinteractants,Ucovariate)
+        for phen in range(n_pheno):
             UY_=UY[:,phen]
-            #loop through all phenotypes
-            #emmaX trick
-            ldelta[phen,snp]=ldelta0[phen,snp]
             #evluate background and foreground
             #null model
-            nLL0_, beta0_, sigg20_=nLLeval(ldelta0[phen,snp],UY_,Ucovariates_,S,MLparams=True)
-            beta0[phen,snp,:]=beta0_
-            sigg20[phen,snp]=sigg20_
-            LL0[phen,snp]=-nLL0_
+            nLL0_,beta0[phen,blk],sigg20[phen,blk]=nLLeval_designs(ldelta0[phen,i],UY_,UD0,S,MLparams=True,nsamples=n)
+            LL0[phen,blk]=-nLL0_
             #foreground model
-            nLL_, beta_, sigg2_=nLLeval(ldelta[phen,snp],UY_,UX_,S,MLparams=True)
-            beta[phen,snp,:]=beta_
-            sigg2[phen,snp]=sigg2_
-            LL[phen,snp]=-nLL_
+            nLL_,beta[phen,blk],sigg2[phen,blk]=nLLeval_designs(ldelta[phen,i],UY_,UD,S,MLparams=True,nsamples=n)
+            LL[phen,blk]=-nLL_
     pval = st.chi2.sf(2*(LL-LL0),1)
     return LL0, LL, pval, ldelta0, sigg20, beta0, ldelta, sigg2, beta
 
 
-def run_interact(Y, intA, intB, covs, K):
-    """ Calculate pvalues for the nested model of including a multiplicative term between intA and intB into the additive model """
+def run_interact(Y, intA, intB, covs, K, G=None, topk=None, chunk_size=1000, numintervals0=10, ldeltamin0=-5.0, ldeltamax0=5.0):
+    """ Calculate the log likelihood ratio (lod) of including a multiplicative term between intA and intB into the additive model
+    If G is given, K=G G.T is never formed and the low-rank likelihood is used
+
+    delta is fitted once per phenotype on the covariates alone (EMMA-X trick)
+    and every (a, b) pair is then evaluated by fixed-delta GLS. Pairs are
+    processed in tiles of at most chunk_size, whose interaction columns are
+    rotated by a single product.
+    Returns lods (Na, Nb, Ny); if topk is given, returns (lods, a, b), each
+    (Ny, topk), holding the topk largest lods per phenotype in decreasing
+    order without materializing the full tensor.
+    """
     [N, Ny] = Y.shape
 
     Na = intA.shape[1] # number of interaction terms 1
     Nb = intB.shape[1] # number of interaction terms 2
 
-    S,U=LA.eigh(K);
-    UY=SP.dot(U.T,Y);
-    UintA=SP.dot(U.T,intA);
-    UintB=SP.dot(U.T,intB);
-    Ucovs=SP.dot(U.T,covs);
-    # for each snp/gene/factor combination, run a lod
-    # snps need to be diced bc of missing values - iterate over them, else in arrays
-    lods = SP.zeros([Na, Nb, Ny])
-
     #add mean column:
-    if covs is None: covs = SP.ones([Ny,1])
-
-    # for each pair of interacting terms
-    for a in range(Na):
-        for b in range(Nb):
-            # calculate additive and interaction terms
-            C = SP.concatenate((Ucovs, UintA[:,a:a+1], UintB[:,b:b+1]))
-            X = intA[:,a:a+1]*intB[:,b:b+1]
-            UX = SP.dot(U.T,X);
-            UX = SP.concatenate((UX, C))
-            for phen in SP.arange(Ny):
-                UY_=UY[:,phen];
-                nllnull,ldeltanull=optdelta(UY_,C,S,ldeltanull=None,numintervals=10,ldeltamin=-5.0,ldeltamax=5.0);
-                nllalt,ldeltaalt=optdelta(UY_,UX,S,ldeltanull=ldeltanull,numintervals=100,ldeltamin=-5.0,ldeltamax=5.0);
-                lods[a,b,phen] = nllalt-nllalt;
-    return lods
+    if covs is None: covs = NP.ones([N,1])
+    Nc = covs.shape[1]
+
+    S,U=eigen(K,G);
+    UY=rotate(U,Y);
+    UintA=rotate(U,intA);
+    UintB=rotate(U,intB);
+    Ucovs=rotate(U,covs);
+
+    ldelta=NP.empty(Ny)
+    for phen in range(Ny):
+        ldelta[phen]=optdelta(UY[:,phen],Ucovs,S,ldeltanull=None,numintervals=numintervals0,ldeltamin=ldeltamin0,ldeltamax=ldeltamax0,nsamples=N)
+
+    if topk is None:
+        lods = NP.zeros([Na, Nb, Ny])
+    else:
+        topk = min(topk, Na*Nb)
+        best = NP.ones([Ny, 0])*(-NP.inf)
+        besti = NP.zeros([Ny, 0], int)
+
+    # tiles of pairs (a, b)
+    bb = min(Nb, chunk_size)
+    ba = max(1, chunk_size // bb)
+    for a0 in range(0, Na, ba):
+        ablk = NP.arange(a0, min(a0+ba, Na))
+        for b0 in range(0, Nb, bb):
+            bblk = NP.arange(b0, min(b0+bb, Nb))
+            na, nb = len(ablk), len(bblk)
+            # stack: interaction, covariates, additive terms
+            X = (intA[:,ablk,NP.newaxis]*intB[:,NP.newaxis,bblk]).reshape(N, na*nb)
+            UX = rotate(U,X)
+            UD = NP.empty((na, nb, UX.shape[0], 3+Nc))
+            UD[...,0] = UX.T.reshape(na, nb, -1)
+            UD[...,1:1+Nc] = Ucovs
+            UD[...,1+Nc] = UintA[:,ablk].T[:,NP.newaxis,:]
+            UD[...,2+Nc] = UintB[:,bblk].T[NP.newaxis,:,:]
+            UD = UD.reshape(na*nb, UX.shape[0], 3+Nc)
+            lod = NP.empty((Ny, na*nb))
+            for phen in range(Ny):
+                UY_=UY[:,phen]
+                nllnull=nLLeval_designs(ldelta[phen],UY_,UD[:,:,1:],S,nsamples=N)
+                nllalt=nLLeval_designs(ldelta[phen],UY_,UD,S,nsamples=N)
+                lod[phen] = nllnull-nllalt
+            if topk is None:
+                lods[ablk[:,NP.newaxis],bblk,:] = lod.T.reshape(na, nb, Ny)
+                continue
+            # merge the tile into the running top-k of every phenotype
+            idx = (ablk[:,NP.newaxis]*Nb+bblk).ravel()
+            best = NP.concatenate((best, lod), axis=1)
+            besti = NP.concatenate((besti, NP.tile(idx, (Ny, 1))), axis=1)
+            if best.shape[1] > topk:
+                keep = NP.argpartition(-best, topk-1, axis=1)[:, :topk]
+                best = NP.take_along_axis(best, keep, 1)
+                besti = NP.take_along_axis(besti, keep, 1)
+    if topk is None:
+        return lods
+    order = NP.argsort(-best, axis=1)
+    best = NP.take_along_axis(best, order, 1)
+    besti = NP.take_along_axis(besti, order, 1)
+    return best, besti // Nb, besti % Nb
@@ -0,0 +1,89 @@
+from __future__ import division
+
+import logging
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+import numpy as NP
+
+from ._fastlmm import eigen
+
+
+def _add_gram(out, G, idx, sign=1, chunk_size=1000):
+    """Adds ``sign * G_idx G_idx.T`` to ``out`` (n, n) in place.
+
+    The columns ``idx`` of ``G`` are read and converted to float64
+    ``chunk_size`` at a time, so a memory-mapped ``G`` is never loaded whole.
+    """
+    tmp = None
+    for i in range(0, len(idx), chunk_size):
+        Gc = NP.asarray(G[:, idx[i:i + chunk_size]], float)
+        if tmp is None:
+            tmp = NP.empty_like(out)
+        NP.dot(Gc, Gc.T, out=tmp)
+        if sign > 0:
+            out += tmp
+        else:
+            out -= tmp
+    return out
+
+
+def loco_kinships(G, Gchrom, chroms=None, chunk_size=1000):
+    """Leave-one-chromosome-out kinships of the background genotypes G (n, m).
+
+    ``G`` can be an array or a memory-mapped array; it is read
+    ``chunk_size`` columns at a time. Only the total kinship ``K = G G.T``
+    is kept. Each LOCO kinship ``K - G_c G_c.T`` is built on demand from the
+    genotype columns of its chromosome, so a single one is alive if the
+    caller drops it before the next. Chromosomes in ``chroms`` without
+    background markers get the full kinship.
+
+    Yields ``(chrom, K_chrom)``.
+    """
+    logger = logging.getLogger(__name__)
+    Gchrom = NP.asarray(Gchrom)
+    if chroms is None:
+        chroms = NP.unique(Gchrom)
+    n = G.shape[0]
+    K = _add_gram(NP.zeros((n, n)), G, NP.arange(G.shape[1]),
+                  chunk_size=chunk_size)
+    for c in chroms:
+        logger.debug('LOCO kinship of chromosome %s.', c)
+        Kc = _add_gram(K.copy(), G, NP.where(Gchrom == c)[0], -1,
+                       chunk_size)
+        yield c, Kc
+
+
+def loco_eigen(G, Gchrom, chroms=None, nprocs=1, scale=None,
+               chunk_size=1000):
+    """Yields ``(chrom, S, U)``, the eigen decompositions of the LOCO kinships.
+
+    The kinships are built by :func:`loco_kinships` and decomposed in
+    ``nprocs`` threads (LAPACK releases the GIL); the decompositions are
+    yielded in chromosome order. At most ``nprocs`` of them are outstanding
+    at a time, so besides the total kinship memory holds about ``nprocs``
+    LOCO kinships and decompositions plus the one being consumed.
+    If given, ``scale(K)`` (e.g. the Gower factor) is applied to the
+    eigenvalues of every LOCO kinship K.
+    """
+    nprocs = max(nprocs, 1)
+
+    def decompose(c, K):
+        f = 1.0 if scale is None else scale(K)
+        S, U = eigen(K, None, f)
+        return c, S, U
+
+    pool = ThreadPool(nprocs)
+    try:
+        pending = deque()
+        for (c, K) in loco_kinships(G, Gchrom, chroms, chunk_size):
+            pending.append(pool.apply_async(decompose, (c, K)))
+            del K
+            if len(pending) >= nprocs:
+                yield pending.popleft().get()
+        while len(pending) > 0:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
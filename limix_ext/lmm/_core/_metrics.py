@@ -0,0 +1,142 @@
+from __future__ import division
+
+import contextlib
+import functools
+import sys
+from collections import OrderedDict
+from timeit import default_timer
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+_metrics = None
+
+
+def _maxrss():
+    r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return r if sys.platform == 'darwin' else 1024 * r
+
+
+class Metrics(object):
+    """Wall time, number of calls and peak memory of every scan stage.
+
+    ``stages`` maps the stage names (``eigen``, ``rotate``, ``delta``,
+    ``snps``, ``score``, ``designs`` and ``cg``) to dicts with the
+    ``seconds`` and ``calls`` accumulated so far and the largest ``bytes``
+    of any call. Bytes are the peak memory allocated during a call above
+    what was allocated when it started, as traced by ``tracemalloc``; they
+    are only recorded with ``track_memory``. Where ``tracemalloc`` cannot
+    reset its peak (Python < 3.9, including Python 2), the growth of the
+    resident set high-water mark is recorded instead, which misses calls
+    that stay below an earlier peak of the process.
+    If given, ``callback(name, seconds, nbytes)`` is called after every
+    stage call.
+    """
+    def __init__(self, callback=None, track_memory=False):
+        self.stages = OrderedDict()
+        self._callback = callback
+        self._traced = (tracemalloc is not None and
+                        hasattr(tracemalloc, 'reset_peak'))
+        self._track_memory = track_memory and (self._traced or
+                                               resource is not None)
+        self._peaks = []
+
+    def run(self, name, func, args, kwargs):
+        if not self._track_memory:
+            start = default_timer()
+            r = func(*args, **kwargs)
+            self.record(name, default_timer() - start)
+            return r
+        if not self._traced:
+            mem = _maxrss()
+            start = default_timer()
+            r = func(*args, **kwargs)
+            self.record(name, default_timer() - start, _maxrss() - mem)
+            return r
+
+        # the peak of an enclosing stage is kept on the stack across the
+        # resets of the stages it calls
+        (current, peak) = tracemalloc.get_traced_memory()
+        if len(self._peaks) > 0:
+            self._peaks[-1] = max(self._peaks[-1], peak)
+        tracemalloc.reset_peak()
+        self._peaks.append(current)
+        start = default_timer()
+        try:
+            r = func(*args, **kwargs)
+        finally:
+            seconds = default_timer() - start
+            peak = max(self._peaks.pop(), tracemalloc.get_traced_memory()[1])
+            if len(self._peaks) > 0:
+                self._peaks[-1] = max(self._peaks[-1], peak)
+        self.record(name, seconds, peak - current)
+        return r
+
+    def record(self, name, seconds, nbytes=0):
+        if name not in self.stages:
+            self.stages[name] = dict(seconds=0., calls=0, bytes=0)
+        stage = self.stages[name]
+        stage['seconds'] += seconds
+        stage['calls'] += 1
+        stage['bytes'] = max(stage['bytes'], nbytes)
+        if self._callback is not None:
+            self._callback(name, seconds, nbytes)
+
+    def __str__(self):
+        lines = ['%-8s %12s %8s %14s' % ('stage', 'seconds', 'calls',
+                                         'bytes')]
+        for (name, s) in self.stages.items():
+            lines.append('%-8s %12.6f %8d %14d' % (name, s['seconds'],
+                                                   s['calls'], s['bytes']))
+        return '\n'.join(lines)
+
+
+@contextlib.contextmanager
+def collect_metrics(callback=None, track_memory=False):
+    """Records the stages of every LMM scan run in the context.
+
+    Yields the :class:`Metrics` being filled. With ``track_memory``,
+    ``tracemalloc`` (Python 3.9 or later) is started if needed, which slows
+    down allocations. Stages run by worker processes (``nprocs > 1``) are not
+    recorded. Outside of this context the instrumentation costs a single
+    check per stage call.
+    """
+    global _metrics
+    previous = _metrics
+    metrics = Metrics(callback, track_memory)
+    started = False
+    if (metrics._track_memory and metrics._traced and
+            not tracemalloc.is_tracing()):
+        tracemalloc.start()
+        started = True
+    _metrics = metrics
+    try:
+        yield metrics
+    finally:
+        _metrics = previous
+        if started:
+            tracemalloc.stop()
+
+
+def disable_metrics():
+    global _metrics
+    _metrics = None
+
+
+def staged(name):
+    """Decorator recording the calls of a function as the stage ``name``."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _metrics is None:
+                return func(*args, **kwargs)
+            return _metrics.run(name, func, args, kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,49 @@
+import os
+from collections import deque
+from multiprocessing import Pool
+
+import numpy as NP
+
+
+def dump_shared(folder, arrays):
+    """Saves read-only arrays as .npy files to be memory-mapped by workers."""
+    for (name, A) in arrays.items():
+        NP.save(os.path.join(folder, name + '.npy'), A)
+
+
+def load_shared(folder):
+    """Memory-maps the arrays saved by dump_shared.
+
+    The pages are backed by the same files in every worker, so the arrays
+    are shared through the page cache instead of being pickled.
+    """
+    r = dict()
+    for fn in os.listdir(folder):
+        if fn.endswith('.npy'):
+            r[fn[:-4]] = NP.load(os.path.join(folder, fn), mmap_mode='r')
+    return r
+
+
+def imap_ordered(func, iterable, nprocs, initializer=None, initargs=(),
+                 window=None):
+    """Maps func over iterable in a process pool, yielding results in order.
+
+    At most ``window`` items (twice the number of processes by default) are
+    in flight, so the iterable is consumed lazily.
+    """
+    if window is None:
+        window = 2 * nprocs
+
+    pool = Pool(nprocs, initializer, initargs)
+    try:
+        pending = deque()
+        for item in iterable:
+            pending.append(pool.apply_async(func, (item, )))
+            if len(pending) >= window:
+                yield pending.popleft().get()
+        while len(pending) > 0:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
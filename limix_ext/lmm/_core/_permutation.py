@@ -0,0 +1,134 @@
+from __future__ import division
+
+import logging
+
+import numpy as NP
+from numpy.random import RandomState
+
+from ._fastlmm import _rotate_data
+from ._fastlmm import fit_null
+from ._fastlmm import rotate
+from ._fastlmm import nLLeval_null_phenos
+from ._fastlmm import nLLeval_snps_phenos
+
+
+def null_phenotypes(y, U, S, Ucovariate, size, kind='permutation', null=None,
+                    seed=None):
+    """A batch of ``size`` rotated null phenotypes, shaped (n, size).
+
+    Permutations of ``y`` are rotated by a single product with ``U``.
+    Bootstrap phenotypes are drawn from the fitted null model
+    ``null = (ldelta0, sigg20, beta0)`` directly in the eigenbasis, where
+    their covariance ``sigg20 * (S + delta0)`` is diagonal. The batch is
+    drawn from ``RandomState(seed)``, so it can be generated again.
+    """
+    random = RandomState(seed)
+    n = y.shape[0]
+    if kind == 'permutation':
+        idx = NP.stack([random.permutation(n) for _ in range(size)], 1)
+        return rotate(U, y[idx])
+    if kind == 'bootstrap':
+        (ldelta0, sigg20, beta0) = null
+        sd = NP.sqrt(sigg20 * (S + NP.exp(ldelta0)))
+        z = random.randn(len(S), size)
+        return (NP.dot(Ucovariate, beta0)[:, NP.newaxis] +
+                sd[:, NP.newaxis] * z)
+    raise ValueError("Unknown kind of null phenotypes: %s." % kind)
+
+
+def null_batches(npermutations, batch_size, random=None):
+    """``(start, size, seed)`` of every batch of null phenotypes.
+
+    The seeds are drawn from ``random`` up front, one per batch.
+    """
+    if random is None:
+        random = RandomState()
+    starts = list(range(0, npermutations, batch_size))
+    seeds = random.randint(2**31 - 1, size=len(starts))
+    return [(i, min(batch_size, npermutations - i), seed)
+            for (i, seed) in zip(starts, seeds)]
+
+
+def _fit_batch(UY, Ucovariate, S, ldeltagrid, n):
+    nll = nLLeval_null_phenos(ldeltagrid, UY, Ucovariate, S, nsamples=n)
+    nll[NP.isnan(nll)] = NP.inf
+    j = NP.argmin(nll, 0)
+    return ldeltagrid[j], -nll[j, NP.arange(nll.shape[1])]
+
+
+def _test_batch(UX, UY, Ucovariate, S, ldelta0, LL0, n, maxstats):
+    nLL = nLLeval_snps_phenos(ldelta0, UY, UX, Ucovariate, S, nsamples=n)
+    stats = 2 * (-nLL - LL0[:, NP.newaxis])
+    stats[NP.logical_not(NP.isfinite(stats))] = 0.
+    NP.maximum(maxstats, stats.max(1), out=maxstats)
+
+
+def permutation_maxstats(blocks, y, K, C=None, npermutations=1000,
+                         kind='permutation', batch_size=100,
+                         numintervals0=100, ldeltamin0=-5.0, ldeltamax0=5.0,
+                         dtype=float, scale=1.0, random=None):
+    """Maximum LRT statistic over all SNPs of every null phenotype.
+
+    ``K`` is decomposed once. The null phenotypes (see
+    :func:`null_phenotypes`) are generated in batches of ``batch_size``,
+    each from its own seed (see :func:`null_batches`), and have their delta
+    fitted on a grid. Only the running maximum statistic of each null
+    phenotype is kept, so memory does not grow with the number of SNPs.
+
+    ``blocks`` is either a function returning a fresh iterable of SNP blocks
+    or an iterable read once. With a function, the batches are the outer
+    loop: every block is rotated and tested against one batch at a time, so
+    only ``batch_size`` null phenotypes are held and memory does not grow
+    with the number of permutations either, at the cost of reading and
+    rotating the SNPs once per batch. An iterable read once is rotated once
+    and tested against every batch, so all the rotated null phenotypes are
+    held, shaped (n, npermutations).
+
+    Returns the maximum statistics, shaped (npermutations,).
+    """
+    logger = logging.getLogger(__name__)
+    n = y.shape[0]
+    Y = y.reshape((n, 1))
+    logger.info('Eigen decomposition')
+    S, U, UY, Ucovariate = _rotate_data(Y, K, C, False, None, scale)
+
+    null = None
+    if kind == 'bootstrap':
+        (_, ldelta0, sigg20, beta0) = fit_null(UY, Ucovariate, S,
+                                               numintervals0, ldeltamin0,
+                                               ldeltamax0, nsamples=n)
+        null = (ldelta0[0], sigg20[0], beta0[0])
+
+    ldeltagrid = (NP.arange(numintervals0 + 1) / (numintervals0 * 1.0) *
+                  (ldeltamax0 - ldeltamin0) + ldeltamin0)
+    batches = null_batches(npermutations, batch_size, random)
+    maxstats = NP.zeros(npermutations)
+    UX_ = U.astype(dtype, copy=False)
+
+    def generate(size, seed):
+        return null_phenotypes(Y[:, 0], U, S, Ucovariate, size, kind, null,
+                               seed)
+
+    if callable(blocks):
+        for (i, b, seed) in batches:
+            logger.info('Null phenotypes %d to %d', i, i + b)
+            UYb = generate(b, seed)
+            (ldelta0, LL0) = _fit_batch(UYb, Ucovariate, S, ldeltagrid, n)
+            for X in blocks():
+                UX = rotate(UX_, NP.asarray(X, dtype))
+                _test_batch(UX, UYb, Ucovariate, S, ldelta0, LL0, n,
+                            maxstats[i:i + b])
+        return maxstats
+
+    logger.info('Generating %d null phenotypes', npermutations)
+    fitted = []
+    for (i, b, seed) in batches:
+        UYb = generate(b, seed)
+        fitted.append((UYb, ) + _fit_batch(UYb, Ucovariate, S, ldeltagrid, n))
+
+    for X in blocks:
+        UX = rotate(UX_, NP.asarray(X, dtype))
+        for ((i, b, _), (UYb, ldelta0, LL0)) in zip(batches, fitted):
+            _test_batch(UX, UYb, Ucovariate, S, ldelta0, LL0, n,
+                        maxstats[i:i + b])
+    return maxstats
@@ -0,0 +1,77 @@
+from __future__ import absolute_import
+from __future__ import division
+
+import logging
+
+import numpy as np
+from numpy import asarray, newaxis
+from numpy.random import RandomState
+
+from ..util import gower_factor
+
+from ._core import null_state
+
+
+def _projection(y, covariates, K):
+    """Terms of ``P`` and ``P y`` in the eigenbasis of ``K``.
+
+    ``P = V^-1 - V^-1 C (C' V^-1 C)^-1 C' V^-1``, with ``V = K + delta I``
+    for the delta of the null model fitted to all samples.
+    """
+    logger = logging.getLogger(__name__)
+    y = asarray(y, float)
+    covariates = asarray(covariates, float)
+
+    logger.info('Null model fitting')
+    arrays, params = null_state(y[:, newaxis], K, C=covariates,
+                                addBiasTerm=False, scale=gower_factor(K))
+    (S, U, UY, UC) = (arrays['S'], arrays['U'], arrays['UY'][:, 0],
+                      arrays['Ucovariate'])
+    w = 1. / (S + np.exp(params['ldelta0'][0]))
+
+    ViC = np.dot(U, UC * w[:, newaxis])
+    A = np.linalg.pinv(np.dot(UC.T * w, UC))
+    Py = np.dot(U, (UY - np.dot(UC, params['beta0'][0])) * w)
+    return (U, w, ViC, A, Py)
+
+
+def loo_predict(y, covariates, K):
+    """Exact leave-one-out predictions of an LMM for all samples at once.
+
+    The variance components are fitted once on all samples. The prediction
+    of every sample is the BLUP given all the others, with the fixed effects
+    re-estimated without it. It equals ``y - (P y)_i / P_ii``, which only
+    needs the diagonal of ``P`` (see :func:`kfold_predict`).
+    """
+    (U, w, ViC, A, Py) = _projection(y, covariates, K)
+    Pdiag = np.dot(U * U, w) - np.einsum('ij,jk,ik->i', ViC, A, ViC)
+    return asarray(y, float) - Py / Pdiag
+
+
+def kfold_predict(y, covariates, K, folds=10, random_state=None):
+    """Exact k-fold cross-validation predictions of an LMM.
+
+    ``folds`` is the number of folds, drawn at random from ``random_state``,
+    or the fold label of every sample. The variance components are fitted
+    once on all samples. The predictions of a fold are the BLUPs given the
+    other folds, with the fixed effects re-estimated without it. They equal
+    ``y_F - P_FF^-1 (P y)_F``, where ``P = V^-1 - V^-1 C (C' V^-1 C)^-1 C'
+    V^-1``. ``P_FF`` is a low-rank downdate of the eigenbasis inverse, so
+    every fold costs a solve of its own size instead of a refit.
+    """
+    y = asarray(y, float)
+    n = y.shape[0]
+    if np.isscalar(folds):
+        if random_state is None:
+            random_state = RandomState()
+        folds = random_state.permutation(n) % folds
+    folds = asarray(folds)
+
+    (U, w, ViC, A, Py) = _projection(y, covariates, K)
+    pred = np.empty(n)
+    for fold in np.unique(folds):
+        i = np.where(folds == fold)[0]
+        Ui = U[i]
+        Pii = np.dot(Ui * w, Ui.T) - np.dot(np.dot(ViC[i], A), ViC[i].T)
+        pred[i] = y[i] - np.linalg.solve(Pii, Py[i])
+    return pred
@@ -0,0 +1,80 @@
+from __future__ import absolute_import
+from __future__ import division
+
+import logging
+
+from numpy import asarray
+from numpy import concatenate
+from numpy import isfinite
+from numpy import logical_not
+from numpy import unique
+from numpy import zeros
+
+from ..util import gower_factor
+from ..util import clone
+
+from ._core import train_cis
+
+
+def _keys(snp_pos, pheno_pos, snp_chrom, pheno_chrom, window):
+    """Positions made comparable across chromosomes.
+
+    Every chromosome is shifted by more than the extent of all positions
+    plus twice the window, so that no window crosses chromosomes.
+    """
+    snp_pos = asarray(snp_pos, float)
+    pheno_pos = asarray(pheno_pos, float)
+    if snp_chrom is None:
+        return (snp_pos, pheno_pos)
+
+    chroms = concatenate([asarray(snp_chrom), asarray(pheno_chrom)])
+    (_, codes) = unique(chroms, return_inverse=True)
+    span = max(snp_pos.max(), pheno_pos.max()) + 2 * window + 1
+    nsnps = len(snp_pos)
+    return (codes[:nsnps] * span + snp_pos, codes[nsnps:] * span + pheno_pos)
+
+
+def cis_scan(Y, covariates, X, K, pheno_pos, snp_pos, window=1000000,
+             pheno_chrom=None, snp_chrom=None, chunk_size=1000, dtype=float):
+    """Cis association scan of many normal phenotypes (e.g. expression).
+
+    Every phenotype (column of ``Y``) at ``pheno_pos`` is tested against the
+    SNPs of ``X`` at ``snp_pos`` within ``window`` of it; chromosomes are
+    optionally given by ``pheno_chrom`` and ``snp_chrom``. ``K`` is
+    decomposed once and the null model of each phenotype is fitted once. A
+    sorted index of the SNP positions gives the window of every phenotype;
+    the rotated SNPs are cached while the phenotypes are visited in order of
+    position, so overlapping windows are rotated only once, ``chunk_size``
+    SNPs at a time.
+
+    Returns ``(phenotypes, snps, pvalues)``: the phenotype and SNP indices of
+    every test and its p-value.
+    """
+    logger = logging.getLogger(__name__)
+    Y = clone(Y)
+    Y -= Y.mean(0)
+    std = Y.std(0)
+    std[std == 0.] = 1.
+    Y /= std
+
+    if covariates is not None:
+        covariates = asarray(covariates, float)
+
+    (snp_key, pheno_key) = _keys(snp_pos, pheno_pos, snp_chrom, pheno_chrom,
+                                 window)
+
+    logger.info('cis scan started')
+    phenotypes = []
+    snps = []
+    pvals = []
+    for (j, s, _, p) in train_cis(X, Y, K, snp_key, pheno_key, window,
+                                  C=covariates, chunk_size=chunk_size,
+                                  dtype=dtype, scale=gower_factor(K)):
+        p = asarray(p, float)
+        p[logical_not(isfinite(p))] = 1.
+        phenotypes.append(zeros(len(s), int) + j)
+        snps.append(s)
+        pvals.append(p)
+    logger.info('cis scan finished')
+
+    return (concatenate(phenotypes), concatenate(snps), concatenate(pvals))
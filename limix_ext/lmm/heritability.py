@@ -1,112 +1,122 @@
 from __future__ import division
 
 import numpy as np
-import scipy as sp
-import scipy.stats
 from numpy import asarray, newaxis
 
+from scipy.stats import norm
+
 from scipy_sugar.stats import quantile_gaussianize
 
-from ..util import gower_normalization
-from ._core import train_associations
+from ..util import gower_factor
+from ._core import train_null
 
 
-def binomial_estimate(nsuccesses, ntrials, covariate, K,
-                      rank_normalize=False):
-    ntrials = np.asarray(ntrials, float)
-    nsuccesses = np.asarray(nsuccesses, float).copy()
-    ntrials = np.asarray(ntrials, float).copy()
+def estimate_null(phenotype, covariate, K):
+    """Fit the covariate-only LMM of one or more phenotypes.
 
-    phenotype = quantile_gaussianize(nsuccesses / ntrials)
+    The phenotypes (``(n,)`` or ``(n, p)``) share a single decomposition of
+    the Gower normalized ``K``; no SNP is involved.
 
-    phenotype = phenotype[:, newaxis]
+    Returns ``(delta, sigg2, sige2, beta)``: the ratio ``sige2 / sigg2``, the
+    genetic and the noise variances, one per phenotype, and the fixed effects
+    shaped ``(p, c)``. Without ``covariate`` an intercept is fitted.
+    """
+    phenotype = asarray(phenotype, float)
+    if phenotype.ndim == 1:
+        phenotype = phenotype[:, newaxis]
+    covariate = _covariate(covariate, phenotype.shape[0])
 
-    covariate = covariate.copy()
+    (_, ldelta, sigg2, beta) = train_null(phenotype, K, C=covariate,
+                                          addBiasTerm=False,
+                                          scale=gower_factor(K))
+    delta = np.exp(ldelta)
+    return (delta, sigg2, delta * sigg2, beta)
 
-    K = np.asarray(K, float)
-    K = gower_normalization(asarray(K, float))
 
-    n = K.shape[0]
-    G = np.random.randint(0, 3, size=(n, 1))
-    G = np.asarray(G, float)
+def _covariate(covariate, n):
+    if covariate is None:
+        return np.ones((n, 1))
+    return asarray(covariate, float)
 
-    (_, _, ldelta, sigg2, beta0) = train_associations(
-        G, phenotype, K, C=covariate, addBiasTerm=False)
 
-    m = np.dot(covariate, beta0.T)
-    varc = np.var(m)
+def _h2(phenotype, covariate, K):
+    covariate = _covariate(covariate, phenotype.shape[0])
+    (_, sigg2, sige2, beta) = estimate_null(phenotype, covariate, K)
+
+    m = np.dot(covariate, beta.T)
+    varc = np.var(m, axis=0)
 
-    delta = np.exp(ldelta)
-    sige2 = delta * sigg2
     h2 = sigg2 / (sigg2 + sige2 + varc)
-    h2 = np.asscalar(np.asarray(h2, float))
+    h2[np.logical_not(np.isfinite(h2))] = 0.
+    return h2
+
+
+def _standardize(y):
+    y = y - y.mean(0)
+    std = y.std(0)
+    std[std == 0.] = 1.
+    return y / std
 
-    if not np.isfinite(h2):
-        h2 = 0.
+
+def _result(h2, ndim):
+    if ndim == 1:
+        return float(h2[0])
     return h2
 
 
-def poisson_estimate(y, covariate, K):
-    ntrials = np.asarray(ntrials, float)
-    y = np.asarray(y, float)
+def binomial_estimate(nsuccesses, ntrials, covariate, K,
+                      rank_normalize=False):
+    """Heritability of binomial counts.
 
-    y = y.copy() / ntrials
-    y -= y.mean()
-    y /= y.std()
-    covariate = covariate.copy()
+    ``nsuccesses`` and ``ntrials`` can be ``(n,)`` or ``(n, p)``, in which case
+    the heritabilities of the ``p`` phenotypes are estimated together.
+    """
+    nsuccesses = asarray(nsuccesses, float)
+    ntrials = asarray(ntrials, float)
+    ndim = nsuccesses.ndim
+    if ndim == 1:
+        nsuccesses = nsuccesses[:, newaxis]
+    if ntrials.ndim == 1:
+        ntrials = ntrials[:, newaxis]
 
-    K = np.asarray(K, float)
-    K = gower_normalization(asarray(K, float))
+    ratios = nsuccesses / ntrials
+    phenotype = np.stack([quantile_gaussianize(ratios[:, i])
+                          for i in range(ratios.shape[1])], axis=1)
 
-    n = K.shape[0]
-    G = np.random.randint(0, 3, size=(n, 1))
-    G = np.asarray(G, float)
-    y_ = y[:, np.newaxis]
+    return _result(_h2(phenotype, covariate, K), ndim)
 
-    (_, _, ldelta, sigg2, beta0) = train_associations(
-        G, y_, K, C=covariate, addBiasTerm=False)
 
-    m = np.dot(covariate, beta0.T)
-    varc = np.var(m)
+def poisson_estimate(y, covariate, K):
+    """Heritability of Poisson counts; ``y`` can be ``(n,)`` or ``(n, p)``."""
+    y = asarray(y, float)
+    ndim = y.ndim
+    if ndim == 1:
+        y = y[:, newaxis]
 
-    delta = np.exp(ldelta)
-    sige2 = delta * sigg2
-    h2 = sigg2 / (sigg2 + sige2 + varc)
-    h2 = np.asscalar(np.asarray(h2, float))
+    return _result(_h2(_standardize(y), covariate, K), ndim)
 
-    if not np.isfinite(h2):
-        h2 = 0.
-    return h2
 
+def _h2_observed_space_correct(h2, prevalence, ascertainment):
+    """Transforms an observed-scale heritability to the liability scale.
 
-def _bernoulli_estimator(y, covariate, K, prevalence, **kwargs):
-    y = y.copy()
-    covariate = covariate.copy()
-    ascertainment = float(sum(y == 1.)) / len(y)
-    y -= y.mean()
-    std = y.std()
-    if std > 0.:
-        y /= std
-    K = gower_kinship_normalization(asarray(K, float))
-
-    n = K.shape[0]
-    G = np.random.randint(0, 3, size=(n, 1))
-    G = np.asarray(G, float)
-    y_ = y[:, np.newaxis]
-
-    (_, _, ldelta, sigg2, beta0) = train_associations(
-        G, y_, K, C=covariate, addBiasTerm=False)
-
-    m = np.dot(covariate, beta0.T)
-    varc = np.var(m)
+    See Lee et al. (2011), Am. J. Hum. Genet., 88(3):294-305.
+    """
+    t = norm.ppf(1 - prevalence)
+    z = norm.pdf(t)
+    k = prevalence * (1 - prevalence)
+    p = ascertainment * (1 - ascertainment)
+    return h2 * k * k / (p * z * z)
 
-    delta = np.exp(ldelta)
-    sige2 = delta * sigg2
-    h2 = sigg2 / (sigg2 + sige2 + varc)
-    h2 = np.asscalar(np.asarray(h2, float))
 
-    h2 = h2_observed_space_correct(h2, prevalence, ascertainment)
+def _bernoulli_estimator(y, covariate, K, prevalence, **kwargs):
+    y = asarray(y, float)
+    ndim = y.ndim
+    if ndim == 1:
+        y = y[:, newaxis]
+    ascertainment = (y == 1.).mean(0)
 
-    if not np.isfinite(h2):
-        h2 = 0.
-    return h2
+    h2 = _h2(_standardize(y), covariate, K)
+    h2 = _h2_observed_space_correct(h2, prevalence, ascertainment)
+    h2[np.logical_not(np.isfinite(h2))] = 0.
+
+    return _result(h2, ndim)
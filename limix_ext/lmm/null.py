@@ -0,0 +1,93 @@
+from __future__ import absolute_import
+from __future__ import division
+
+import logging
+
+import numpy as np
+from numpy import asarray
+from numpy import ascontiguousarray
+from numpy import concatenate
+from numpy import isfinite
+from numpy import logical_not
+from numpy import newaxis
+
+from ..util import gower_factor
+from ..util import clone
+
+from ._core import null_state
+from ._core import scan_block
+
+
+class NullModel(object):
+    """Fitted null model of a normally distributed phenotype.
+
+    It holds the eigen decomposition of the Gower normalized ``K``, the
+    rotated phenotype and covariates, and the fitted delta, so that new SNP
+    batches can be tested by :meth:`scan` without refitting anything.
+    :meth:`save` stores it in a single ``.npz`` file that :meth:`load` reads
+    back. ``dtype``, ``method`` and ``score_threshold`` are as in
+    :func:`limix_ext.lmm.qtl.normal_scan`; with ``float32`` the decomposition
+    is stored in half the space.
+    """
+    def __init__(self, y, covariates, K, dtype=float, method='lrt',
+                 score_threshold=1e-4):
+        logger = logging.getLogger(__name__)
+        y = clone(y)
+
+        y -= y.mean()
+        std = y.std()
+        if std > 0.:
+            y /= std
+
+        y = y[:, newaxis]
+
+        if covariates is not None:
+            covariates = asarray(covariates, float)
+
+        logger.info('Null model fitting')
+        arrays, params = null_state(y, K, C=covariates, addBiasTerm=False,
+                                    dtype=dtype, scale=gower_factor(K),
+                                    method=method,
+                                    score_threshold=score_threshold)
+        self._state = dict(arrays)
+        self._state.update(params)
+
+    @property
+    def delta(self):
+        return float(np.exp(self._state['ldelta0'][0]))
+
+    @property
+    def genetic_variance(self):
+        return float(self._state['sigg20'][0])
+
+    @property
+    def noise_variance(self):
+        return self.delta * self.genetic_variance
+
+    @property
+    def beta(self):
+        return self._state['beta0'][0]
+
+    def scan(self, X, chunk_size=1000):
+        """P-values of the SNPs ``X`` (n, s) against the null model."""
+        d = self._state
+        pvals = []
+        for i in range(0, X.shape[1], chunk_size):
+            (_, arg2) = scan_block(X[:, i:i + chunk_size], d)
+            p = ascontiguousarray(arg2, float).ravel()
+            p[logical_not(isfinite(p))] = 1.
+            pvals.append(p)
+        return concatenate(pvals)
+
+    def save(self, file):
+        """Stores the null model in ``file`` (a ``.npz`` path or file)."""
+        np.savez(file, **self._state)
+
+    @classmethod
+    def load(cls, file):
+        """Reads back a null model stored by :meth:`save`."""
+        model = cls.__new__(cls)
+        with np.load(file) as f:
+            model._state = dict((k, f[k] if f[k].ndim > 0 else f[k].item())
+                                for k in f.files)
+        return model
@@ -0,0 +1,77 @@
+from __future__ import absolute_import
+from __future__ import division
+
+import logging
+
+from numpy import asarray
+from numpy import percentile
+from numpy.random import RandomState
+
+from scipy.stats import chi2
+
+from ..util import gower_factor
+from ..util import clone
+
+from ._core import permutation_maxstats
+from .qtl import _blocks
+
+
+def normal_permutation_scan(y, covariates, X, K, npermutations=1000,
+                            kind='permutation', batch_size=100,
+                            chunk_size=1000, dtype=float, copy=True,
+                            random_state=None):
+    """Minimum p-value of the association scan of permuted phenotypes.
+
+    It replaces ``npermutations`` calls to :func:`limix_ext.lmm.qtl.
+    normal_scan` on permuted phenotypes: ``K`` is decomposed once, the null
+    phenotypes are rotated in batches of ``batch_size`` by a single product
+    and every block of ``chunk_size`` SNPs is tested against a whole batch
+    at once. Only the best statistic of each null phenotype is kept.
+
+    If ``X`` is an array or a memory-mapped array, it is read once per batch
+    of null phenotypes, so only ``batch_size`` of them are held at a time.
+    An iterable of SNP blocks is read once instead, and all the null
+    phenotypes are held. Every batch is drawn from its own seed, taken from
+    ``random_state``.
+
+    With ``kind='bootstrap'`` the null phenotypes are drawn from the null
+    model fitted to ``y`` (parametric bootstrap) instead of being
+    permutations of ``y``.
+
+    The empirical significance threshold at level ``alpha`` is the
+    ``alpha`` quantile of the returned p-values (see :func:`threshold`).
+    """
+    logger = logging.getLogger(__name__)
+    if random_state is None:
+        random_state = RandomState()
+
+    y = clone(y)
+
+    y -= y.mean()
+    std = y.std()
+    if std > 0.:
+        y /= std
+
+    scale = gower_factor(K)
+    if covariates is not None:
+        covariates = clone(covariates) if copy else asarray(covariates, float)
+
+    logger.info('Permutation scan started')
+    if hasattr(X, 'shape') and len(X.shape) == 2:
+        # arrays and memmaps are read once per batch of null phenotypes
+        def blocks():
+            return _blocks(X, chunk_size, dtype, copy)
+    else:
+        blocks = _blocks(X, chunk_size, dtype, copy)
+    maxstats = permutation_maxstats(blocks, y, K, C=covariates,
+                                    npermutations=npermutations, kind=kind,
+                                    batch_size=batch_size, dtype=dtype,
+                                    scale=scale, random=random_state)
+    logger.info('Permutation scan finished')
+
+    return chi2.sf(maxstats, 1)
+
+
+def threshold(pvalues, alpha=0.05):
+    """Empirical genome-wide significance threshold at level ``alpha``."""
+    return percentile(pvalues, 100 * alpha)
@@ -1,29 +1,86 @@
-# from __future__ import division
-# import numpy as np
-# import GPy
-# from numpy import asarray
-# from . import core
-#
-# def predict(y, covariate_train, G_train, covariate_test, G_test):
-#
-#     G_train = np.hstack([covariate_train, G_train])
-#     G_test = np.hstack([covariate_test, G_test])
-#
-#     kernel = GPy.kern.Linear(input_dim=G_train.shape[1])
-#     m = GPy.models.GPRegression(G_train, y[:,np.newaxis], kernel)
-#     m.optimize(messages=True)
-#     p = m.predict(G_test)
-#     return -p[0].ravel()
-#
-# if __name__ == '__main__':
-#
-#     np.random.seed(32908742)
-#     G_train = np.random.randn(500, 600)
-#     G_test = np.random.randn(50, 600)
-#
-#     covariate_train = np.ones((500, 1))
-#     covariate_test = np.ones((50, 1))
-#
-#     y = np.random.randint(0, 2, size=500)
-#
-#     y_pred, sigma2_pred = predict(y, covariate_train, G_train, covariate_test, G_test)
+from __future__ import absolute_import
+from __future__ import division
+
+import logging
+
+import numpy as np
+from numpy import asarray, newaxis
+
+from ..util import gower_factor
+
+from ._core import null_state
+
+
+class BLUP(object):
+    """Best linear unbiased predictor of an LMM fitted to training data.
+
+    The model ``y = covariates beta + g + e``, with ``g ~ N(0, sigg2 K)`` and
+    ``e ~ N(0, delta sigg2 I)``, is fitted once from the eigen decomposition
+    of the Gower normalized ``K``. The weights ``(K + delta I)^-1 (y -
+    covariates beta)`` are then computed once, so predicting any batch of
+    test individuals is a single product with their cross-kinship.
+    The fixed effects are taken as known in the predictive variances.
+    """
+    def __init__(self, y, covariates, K):
+        logger = logging.getLogger(__name__)
+        y = asarray(y, float)
+        covariates = asarray(covariates, float)
+
+        self._scale = gower_factor(K)
+        logger.info('Null model fitting')
+        arrays, params = null_state(y[:, newaxis], K, C=covariates,
+                                    addBiasTerm=False, scale=self._scale)
+        (S, U) = (arrays['S'], arrays['U'])
+        self._ldelta = params['ldelta0'][0]
+        self._sigg2 = params['sigg20'][0]
+        self._beta = params['beta0'][0]
+
+        self._Sd = S + self.delta
+        res = arrays['UY'][:, 0] - np.dot(arrays['Ucovariate'], self._beta)
+        self._weights = np.dot(U, res / self._Sd)
+        self._U = U
+        self._W = None
+
+    @property
+    def delta(self):
+        return float(np.exp(self._ldelta))
+
+    @property
+    def genetic_variance(self):
+        return float(self._sigg2)
+
+    @property
+    def noise_variance(self):
+        return self.delta * self.genetic_variance
+
+    @property
+    def beta(self):
+        return self._beta
+
+    @property
+    def weights(self):
+        """Weights of the predictive means, ``(K + delta I)^-1 (y - C beta)``.
+        """
+        return self._weights
+
+    def predict(self, Kcross, covariates, Kdiag=None):
+        """Predictive means of test individuals.
+
+        ``Kcross`` is the test-by-train cross-kinship, computed like ``K``
+        (it is Gower normalized with the factor of ``K``) and ``covariates``
+        the test covariates. If the diagonal ``Kdiag`` of the test kinship is
+        given, the predictive variances of the test phenotypes are returned as
+        well.
+        """
+        Kcross = asarray(Kcross, float)
+        mean = np.dot(asarray(covariates, float), self._beta)
+        mean += self._scale * np.dot(Kcross, self._weights)
+        if Kdiag is None:
+            return mean
+
+        if self._W is None:
+            self._W = self._U / np.sqrt(self._Sd)
+        KW = self._scale * np.dot(Kcross, self._W)
+        var = self._scale * asarray(Kdiag, float) - (KW * KW).sum(1)
+        var = self._sigg2 * (var + self.delta)
+        return (mean, var)
@@ -3,61 +3,260 @@ from __future__ import division
 
 import logging
 
+from numpy import asarray
 from numpy import ascontiguousarray
 from numpy import logical_not
 from numpy import isfinite
 from numpy import newaxis
 from numpy import argsort
 from numpy import clip
+from numpy import concatenate
+from numpy import arange
+from numpy import exp
+from numpy import ones
+from numpy import unique
+from numpy import where
+from numpy import ix_
 
 from scipy.stats import norm
 
 from scipy_sugar.stats import quantile_gaussianize
 
-from ..util import gower_normalization
+from ..util import gower_factor
 from ..util import clone
 
-from ._core import train_associations
+from ._core import train_associations_blocks
+from ._core import train_associations_resume
+from ._core import loco_eigen
+from ._core import train_associations_cg
+from .writer import open_writer
 
 
-def normal_scan(y, covariates, X, K):
+def _blocks(X, chunk_size, dtype, copy):
+    """Yields blocks of columns of X converted to dtype.
+
+    X can be an array, a memory-mapped array, or an iterable of SNP blocks.
+    Only one block is held in memory at a time. Unless ``copy`` is set, blocks
+    already of the right dtype are passed through as views.
+    """
+    convert = clone if copy else asarray
+    if hasattr(X, 'shape') and len(X.shape) == 2:
+        for i in range(0, X.shape[1], chunk_size):
+            yield convert(X[:, i:i + chunk_size], dtype)
+    else:
+        for block in X:
+            yield convert(block, dtype)
+
+
+def _scan(phenotype, covariates, X, K, chunk_size, callback, copy, dtype,
+          **kwargs):
     logger = logging.getLogger(__name__)
     logger.info('Gower normalizing')
 
-    y = clone(y)
-    X = clone(X)
-    K = clone(K)
-    covariates = clone(covariates)
+    # K is never copied: the Gower factor is applied to its eigenvalues
+    scale = gower_factor(K)
+    if covariates is not None:
+        covariates = clone(covariates) if copy else asarray(covariates, float)
+
+    logger.info('train_association started')
+    offset = 0
+    pvals = []
+    blocks = _blocks(X, chunk_size, dtype, copy)
+    checkpoint = kwargs.pop('checkpoint', None)
+    output = kwargs.pop('output', None)
+    writer = None
+    if output is not None:
+        writer = open_writer(output)
+        kwargs['records'] = True
+    if checkpoint is None:
+        results = train_associations_blocks(blocks, phenotype, K,
+                                            C=covariates, addBiasTerm=False,
+                                            dtype=dtype, scale=scale,
+                                            **kwargs)
+    else:
+        results = train_associations_resume(checkpoint, blocks, phenotype, K,
+                                            C=covariates, addBiasTerm=False,
+                                            dtype=dtype, scale=scale,
+                                            **kwargs)
+    try:
+        for r in results:
+            p = ascontiguousarray(r[1], float).ravel()
+            p[logical_not(isfinite(p))] = 1.
+            if writer is not None:
+                writer.write(dict(snp=arange(offset, offset + len(p)),
+                                  beta=r[5][0], se=r[6][0], stat=r[0][0],
+                                  pvalue=p, delta=exp(r[7][0])))
+            if callback is not None:
+                callback(offset, p)
+            offset += len(p)
+            pvals.append(p)
+    finally:
+        if writer is not None:
+            writer.close()
+    logger.info('train_association finished')
 
-    gower_normalization(K, out=K)
+    return concatenate(pvals)
+
+
+def _cg_scan(phenotype, covariates, X, G, chunk_size, callback, copy, dtype,
+             random_state):
+    logger = logging.getLogger(__name__)
+    if G is None:
+        raise ValueError("The cg engine requires the genotypes G.")
+    if covariates is not None:
+        covariates = clone(covariates) if copy else asarray(covariates, float)
+
+    logger.info('train_association_cg started')
+    offset = 0
+    pvals = []
+    blocks = _blocks(X, chunk_size, dtype, copy)
+    for r in train_associations_cg(blocks, phenotype, G, C=covariates,
+                                   dtype=dtype, random=random_state):
+        p = ascontiguousarray(r[1], float).ravel()
+        p[logical_not(isfinite(p))] = 1.
+        if callback is not None:
+            callback(offset, p)
+        offset += len(p)
+        pvals.append(p)
+    logger.info('train_association_cg finished')
+
+    return concatenate(pvals)
+
+
+def _loco_scan(phenotype, covariates, X, chrom, G, Gchrom, chunk_size, copy,
+               dtype, nprocs, **kwargs):
+    logger = logging.getLogger(__name__)
+    chrom = asarray(chrom)
+    if covariates is not None:
+        covariates = clone(covariates) if copy else asarray(covariates, float)
+
+    convert = clone if copy else asarray
+    pvals = ones(X.shape[1])
+    eigens = loco_eigen(G, Gchrom, chroms=unique(chrom), nprocs=nprocs,
+                        scale=gower_factor, chunk_size=chunk_size)
+    for (c, S, U) in eigens:
+        logger.info('Scanning chromosome %s', c)
+        idx = where(chrom == c)[0]
+        blocks = (convert(X[:, idx[i:i + chunk_size]], dtype)
+                  for i in range(0, len(idx), chunk_size))
+        offset = 0
+        for r in train_associations_blocks(blocks, phenotype, None,
+                                           C=covariates, addBiasTerm=False,
+                                           nprocs=nprocs, dtype=dtype,
+                                           eig=(S, U), **kwargs):
+            p = ascontiguousarray(r[1], float).ravel()
+            p[logical_not(isfinite(p))] = 1.
+            pvals[idx[offset:offset + len(p)]] = p
+            offset += len(p)
+
+    return pvals
+
+
+def _patterns(mask):
+    """Groups the columns of mask by their pattern of observed samples.
+
+    Returns a list of ``(samples, columns)`` index arrays, in order of first
+    appearance of every pattern.
+    """
+    groups = dict()
+    order = []
+    for j in range(mask.shape[1]):
+        key = mask[:, j].tobytes()
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        groups[key].append(j)
+    return [(where(mask[:, groups[k][0]])[0], asarray(groups[k]))
+            for k in order]
+
+
+def normal_scan(y, covariates, X, K, chunk_size=1000, callback=None,
+                nprocs=1, dtype=float, copy=True, method='lrt',
+                score_threshold=1e-4, checkpoint=None,
+                output=None, engine='eigen', G=None, random_state=0):
+    """Association scan of a normally distributed phenotype.
+
+    ``X`` can be an array, a memory-mapped array, or an iterable of
+    ``(n, s_block)`` SNP blocks; it is processed ``chunk_size`` SNPs at a time.
+    If given, ``callback(offset, pvals)`` is called as every block completes.
+    With ``nprocs > 1`` the blocks are scanned by a pool of processes.
+
+    ``dtype`` sets the precision of the genotype rotation and of the per-SNP
+    tests; the null model is always fitted in float64. With ``float32`` the
+    memory traffic is halved and the p-values agree with the ``float64`` ones
+    to a relative error below 1e-4 (checked by ``test_normal_float32``).
+
+    ``K`` is never copied nor modified; its Gower normalization is applied to
+    its eigenvalues. With ``copy=False``, covariates and genotype blocks
+    (including memory maps) that already have the right dtype are used in
+    place as well; the caller must then not modify them during the scan.
+
+    With ``method='score'`` every SNP is first screened by a score test, which
+    only requires the null model, and only SNPs with score p-value below
+    ``score_threshold`` are refitted for the exact likelihood ratio test.
+
+    If ``checkpoint`` is a folder, the fitted null state and every finished
+    block are written to it atomically; rerunning the same scan (same
+    phenotype, covariates, ``K``, blocks and options) after an interruption
+    skips them. Blocks are read again to verify they did not change.
+
+    If ``output`` is a ``.h5``, ``.hdf5`` or ``.parquet`` file path, a record
+    per SNP is appended to it as every block completes: its index, effect
+    ``beta`` and standard error ``se``, the test statistic ``stat``, the
+    p-value and the ``delta`` of its model (see
+    :func:`limix_ext.lmm.writer.open_writer`). With ``method='score'`` the
+    SNPs that are not refitted get the score statistic and the one-step
+    effect estimate.
+
+    With ``engine='cg'`` the kinship is never formed nor decomposed: ``K`` is
+    ignored and the kinship is instead the Gower normalized ``G G.T / m`` of
+    the standardized genotypes ``G`` (n, m). The variance components are
+    fitted by the method of moments, with stochastic trace estimates, and
+    the GLS solves are carried out by conjugate gradients over products with
+    ``G``. Every SNP gets a calibrated score test (as in BOLT-LMM).
+    ``random_state`` (a seed or ``RandomState``) draws the stochastic trace
+    probes and the calibration SNPs; with its fixed default the scan is
+    reproducible. ``K``, ``method``, ``score_threshold``, ``nprocs``,
+    ``checkpoint`` and ``output`` do not apply to this engine, and a
+    ``ValueError`` is raised if any of them is set.
+    """
+    y = clone(y)
 
     y -= y.mean()
     std = y.std()
     if std > 0.:
         y /= std
 
-    y = y[:, newaxis]
+    if engine == 'cg':
+        options = [('method', method, 'lrt'),
+                   ('score_threshold', score_threshold, 1e-4),
+                   ('nprocs', nprocs, 1), ('checkpoint', checkpoint, None),
+                   ('output', output, None)]
+        unsupported = [name for (name, value, default) in options
+                       if value != default]
+        if K is not None:
+            unsupported.insert(0, 'K')
+        if len(unsupported) > 0:
+            raise ValueError("The cg engine does not support %s."
+                             % ', '.join(unsupported))
+        return _cg_scan(y, covariates, X, G, chunk_size, callback, copy,
+                        dtype, random_state)
+    elif engine != 'eigen':
+        raise ValueError("Unknown engine: %s." % engine)
 
-    logger.info('train_association started')
-    (stats, pvals, _, _, _) = train_associations(X, y, K, C=covariates,
-                                             addBiasTerm=False)
-    logger.info('train_association finished')
-    pvals = ascontiguousarray(pvals, float).ravel()
-    nok = logical_not(isfinite(pvals))
-    pvals[nok] = 1.
+    y = y[:, newaxis]
 
-    return pvals
+    return _scan(y, covariates, X, K, chunk_size, callback, copy,
+                 dtype, nprocs=nprocs, method=method,
+                 score_threshold=score_threshold, checkpoint=checkpoint,
+                 output=output)
 
-def bernoulli_scan(outcome, X, K, covariates):
-    logger = logging.getLogger(__name__)
-    logger.info('Gower normalizing')
 
+def bernoulli_scan(outcome, X, K, covariates, chunk_size=1000, callback=None,
+                   nprocs=1, dtype=float, copy=True, method='lrt',
+                   score_threshold=1e-4, checkpoint=None, output=None):
+    """Association scan of a binary outcome; see :func:`normal_scan`."""
     outcome = clone(outcome)
-    X = clone(X)
-    K = clone(K)
-    covariates = clone(covariates)
-
-    gower_normalization(K, out=K)
 
     outcome -= outcome.mean()
     std = outcome.std()
@@ -66,33 +265,19 @@ def bernoulli_scan(outcome, X, K, covariates):
 
     outcome = outcome[:, newaxis]
 
-    logger.info('train_association started')
-    (stats, pvals, _, _, _) = train_associations(X, outcome, K, C=covariates,
-                                                 addBiasTerm=False)
-    logger.info('train_association finished')
-    pvals = ascontiguousarray(pvals, float).ravel()
-    nok = logical_not(isfinite(pvals))
-    pvals[nok] = 1.
-
-    stats = ascontiguousarray(stats, float).ravel()
-    stats[nok] = 0.
+    return _scan(outcome, covariates, X, K, chunk_size, callback, copy,
+                 dtype, nprocs=nprocs, method=method,
+                 score_threshold=score_threshold, checkpoint=checkpoint,
+                 output=output)
 
-    return pvals
-
-
-def binomial_scan(nsuccesses, ntrials, X, K, covariates, rank_normalize=False):
-    logger = logging.getLogger(__name__)
-
-    logger.info('Gower normalizing')
 
+def binomial_scan(nsuccesses, ntrials, X, K, covariates, rank_normalize=False,
+                  chunk_size=1000, callback=None, nprocs=1, dtype=float,
+                  copy=True, method='lrt', score_threshold=1e-4,
+                  checkpoint=None, output=None):
+    """Association scan of binomial counts; see :func:`normal_scan`."""
     nsuccesses = clone(nsuccesses)
     ntrials = clone(ntrials)
-    X = clone(X)
-    K = clone(K)
-    covariates = clone(covariates)
-
-    gower_normalization(K, out=K)
-
 
     if rank_normalize:
         phenotype = quantile_gaussianize(nsuccesses / ntrials)
@@ -101,29 +286,18 @@ def binomial_scan(nsuccesses, ntrials, X, K, covariates, rank_normalize=False):
 
     phenotype = phenotype[:, newaxis]
 
-    logger.info('train_association started')
-    (stats, pvals, _, _, _) = train_associations(X, phenotype, K, C=covariates,
-                                                 addBiasTerm=False)
-    logger.info('train_association finished')
-    pvals = ascontiguousarray(pvals, float).ravel()
-    nok = logical_not(isfinite(pvals))
-    pvals[nok] = 1.
-
-    stats = ascontiguousarray(stats, float).ravel()
-    stats[nok] = 0.
-
-    return pvals
+    return _scan(phenotype, covariates, X, K, chunk_size, callback, copy,
+                 dtype, nprocs=nprocs, method=method,
+                 score_threshold=score_threshold, checkpoint=checkpoint,
+                 output=output)
 
-def poisson_scan(noccurrences, X, K, covariates):
-    logger = logging.getLogger(__name__)
-    logger.info('Gower normalizing')
 
+def poisson_scan(noccurrences, X, K, covariates, chunk_size=1000,
+                 callback=None, nprocs=1, dtype=float, copy=True,
+                 method='lrt', score_threshold=1e-4, checkpoint=None,
+                 output=None):
+    """Association scan of Poisson counts; see :func:`normal_scan`."""
     noccurrences = clone(noccurrences)
-    X = clone(X)
-    K = clone(K)
-    covariates = clone(covariates)
-
-    gower_normalization(K, out=K)
 
     noccurrences -= noccurrences.mean()
     std = noccurrences.std()
@@ -132,16 +306,93 @@ def poisson_scan(noccurrences, X, K, covariates):
 
     noccurrences = noccurrences[:, newaxis]
 
-    logger.info('train_association started')
-    (stats, pvals, _, _, _) = train_associations(X, noccurrences, K,
-                                                 C=covariates,
-                                                 addBiasTerm=False)
-    logger.info('train_association finished')
-    pvals = ascontiguousarray(pvals, float).ravel()
-    nok = logical_not(isfinite(pvals))
-    pvals[nok] = 1.
+    return _scan(noccurrences, covariates, X, K, chunk_size, callback, copy,
+                 dtype, nprocs=nprocs, method=method,
+                 score_threshold=score_threshold, checkpoint=checkpoint,
+                 output=output)
+
+
+def normal_loco_scan(y, covariates, X, chrom, G=None, Gchrom=None,
+                     chunk_size=1000, nprocs=1, dtype=float, copy=True,
+                     method='lrt', score_threshold=1e-4):
+    """Leave-one-chromosome-out association scan of a normal phenotype.
 
-    stats = ascontiguousarray(stats, float).ravel()
-    stats[nok] = 0.
+    The SNPs of ``X`` on chromosome ``chrom[i]`` are tested against the
+    kinship of the background genotypes ``G`` from all the other chromosomes;
+    ``Gchrom`` gives the chromosome of every column of ``G``. By default the
+    tested SNPs are also the background ones (``G = X``).
+
+    The Gram contribution of every chromosome is computed once and each LOCO
+    kinship is obtained by subtraction from their sum. The LOCO kinships are
+    Gower normalized and decomposed by ``nprocs`` threads; ``nprocs`` is also
+    used to scan the blocks of each chromosome (see :func:`normal_scan`).
+    """
+    if G is None:
+        G = X
+        Gchrom = chrom
+
+    y = clone(y)
+
+    y -= y.mean()
+    std = y.std()
+    if std > 0.:
+        y /= std
+
+    y = y[:, newaxis]
+
+    return _loco_scan(y, covariates, X, chrom, G, Gchrom, chunk_size, copy,
+                      dtype, nprocs, method=method,
+                      score_threshold=score_threshold)
+
+
+def normal_multi_scan(Y, covariates, X, K, chunk_size=1000, nprocs=1,
+                      dtype=float, method='lrt', score_threshold=1e-4):
+    """Association scan of many normal phenotypes with missing values.
+
+    ``Y`` is ``(n, p)``, with missing values marked as NaN. Each phenotype is
+    tested on its observed samples, as :func:`normal_scan` on the
+    corresponding subsets would do. The phenotypes are grouped by pattern of
+    missing values: the kinship of each distinct sample subset is decomposed
+    once, and every SNP block is rotated once for all phenotypes of a
+    pattern.
+
+    Returns the p-values shaped ``(p, s)``.
+    """
+    logger = logging.getLogger(__name__)
+    Y = clone(Y)
+    mask = isfinite(Y)
+    pvals = ones((Y.shape[1], X.shape[1]))
+    if covariates is not None:
+        covariates = asarray(covariates, float)
+
+    patterns = _patterns(mask)
+    logger.info('%d patterns of missing values', len(patterns))
+    for (samples, columns) in patterns:
+        if len(samples) == 0:
+            continue
+        Ys = Y[ix_(samples, columns)]
+        Ys -= Ys.mean(0)
+        std = Ys.std(0)
+        std[std == 0.] = 1.
+        Ys /= std
+
+        if len(samples) == Y.shape[0]:
+            (Ks, Cs) = (K, covariates)
+        else:
+            Ks = K[ix_(samples, samples)]
+            Cs = None if covariates is None else covariates[samples]
+
+        blocks = (asarray(X[:, i:i + chunk_size][samples], dtype)
+                  for i in range(0, X.shape[1], chunk_size))
+        offset = 0
+        for r in train_associations_blocks(blocks, Ys, Ks, C=Cs,
+                                           addBiasTerm=False, nprocs=nprocs,
+                                           dtype=dtype, scale=gower_factor(Ks),
+                                           method=method,
+                                           score_threshold=score_threshold):
+            p = ascontiguousarray(r[1], float)
+            p[logical_not(isfinite(p))] = 1.
+            pvals[columns, offset:offset + p.shape[1]] = p
+            offset += p.shape[1]
 
     return pvals
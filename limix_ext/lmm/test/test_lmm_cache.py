@@ -0,0 +1,79 @@
+import os
+
+from numpy.random import RandomState
+from numpy import (sqrt, ones, asarray, dot, eye)
+from numpy.testing import assert_allclose, assert_equal
+
+from limix_ext._path import temp_folder
+from limix_ext.lmm import enable_eigen_cache, disable_eigen_cache
+from limix_ext.lmm.qtl import normal_scan
+
+
+def _data(random, n=50, p=54):
+    G = random.randint(3, size=(n, p))
+    G = asarray(G, dtype=float)
+    G -= G.mean(axis=0)
+    G /= G.std(axis=0)
+    G /= sqrt(p)
+
+    K = dot(G, G.T)
+    K = 0.5 * K / K.diagonal().mean() + 0.5 * eye(n)
+
+    y = random.multivariate_normal(ones(n) * 0.4, K)
+    return (y, G, K)
+
+
+def test_eigen_cache():
+    random = RandomState(981)
+    (y, G, K) = _data(random)
+    covariates = ones((y.shape[0], 1))
+    pvalues = normal_scan(y, covariates, G, K)
+
+    with temp_folder() as folder:
+        cache = enable_eigen_cache(folder)
+        try:
+            assert_allclose(normal_scan(y, covariates, G, K), pvalues)
+            assert_equal(len(cache.entries()), 1)
+            assert_allclose(normal_scan(y, covariates, G, K), pvalues)
+            assert_equal(len(cache.entries()), 1)
+
+            normal_scan(y, covariates, G, K + eye(K.shape[0]))
+            assert_equal(len(cache.entries()), 2)
+        finally:
+            disable_eigen_cache()
+
+
+def test_eigen_cache_eviction():
+    random = RandomState(981)
+    (y, G, K) = _data(random)
+    covariates = ones((y.shape[0], 1))
+
+    with temp_folder() as folder:
+        cache = enable_eigen_cache(folder, max_size=1)
+        try:
+            normal_scan(y, covariates, G, K)
+            first = cache.entries()[0][2]
+            normal_scan(y, covariates, G, K + eye(K.shape[0]))
+            entries = cache.entries()
+            assert_equal(len(entries), 1)
+            assert entries[0][2] != first
+            assert not os.path.exists(os.path.join(folder, first))
+        finally:
+            disable_eigen_cache()
+
+def test_eigen_cache_evicted_by_another_process():
+    random = RandomState(981)
+    (y, G, K) = _data(random)
+    covariates = ones((y.shape[0], 1))
+    pvalues = normal_scan(y, covariates, G, K)
+
+    with temp_folder() as folder:
+        cache = enable_eigen_cache(folder)
+        cache.get = lambda key: None
+        try:
+            assert_allclose(normal_scan(y, covariates, G, K), pvalues)
+        finally:
+            disable_eigen_cache()
+
+if __name__ == '__main__':
+    __import__('pytest').main([__file__, '-s'])
@@ -0,0 +1,191 @@
+from numpy.random import RandomState
+from numpy import (sqrt, ones, asarray, dot, eye, hstack, linspace)
+from numpy.linalg import eigh, solve
+from numpy.testing import assert_allclose, assert_equal
+
+from limix_ext._path import temp_folder
+from limix_ext.lmm._core._fastlmm import nLLeval
+from limix_ext.lmm._core._fastlmm import nLLeval_grid
+from limix_ext.lmm._core._fastlmm import nLLeval_snps
+from limix_ext.lmm._core._fastlmm import snp_information
+from limix_ext.lmm._core._fastlmm import train_associations
+from limix_ext.lmm._core._fastlmm import train_associations_blocks
+from limix_ext.lmm._core._fastlmm import train_interactX
+from limix_ext.lmm._core._fastlmm import run_interact
+from limix_ext.lmm._core import collect_metrics
+from limix_ext.lmm._core import train_associations_resume
+from limix_ext.lmm._core import loco_kinships
+from limix_ext.lmm._core._cg import cg_solve
+
+
+def _data(random, n=50, p=54):
+    G = random.randint(3, size=(n, p))
+    G = asarray(G, dtype=float)
+    G -= G.mean(axis=0)
+    G /= G.std(axis=0)
+    G /= sqrt(p)
+
+    K = dot(G, G.T)
+    K = 0.5 * K / K.diagonal().mean() + 0.5 * eye(n)
+
+    y = random.multivariate_normal(ones(n) * 0.4, K)
+    C = hstack((ones((n, 1)), random.randn(n, 2)))
+    return (y, C, G, K)
+
+
+def test_nLLeval_grid():
+    random = RandomState(981)
+    (y, C, _, K) = _data(random)
+    S, U = eigh(K)
+    UY = dot(U.T, y)
+    UC = dot(U.T, C)
+
+    ldeltagrid = linspace(-5, 5, 11)
+    nLL, beta, sigg2 = nLLeval_grid(ldeltagrid, UY, UC, S, MLparams=True)
+    for i, ldelta in enumerate(ldeltagrid):
+        nLL_, beta_, sigg2_ = nLLeval(ldelta, UY, UC, S, MLparams=True)
+        assert_allclose(nLL[i], nLL_)
+        assert_allclose(beta[i], beta_)
+        assert_allclose(sigg2[i], sigg2_)
+
+
+def test_nLLeval_snps():
+    random = RandomState(981)
+    (y, C, G, K) = _data(random)
+    S, U = eigh(K)
+    UY = dot(U.T, y)
+    UC = dot(U.T, C)
+    UX = dot(U.T, G)
+
+    nLL, beta, sigg2, r = nLLeval_snps(0.3, UY, UX, UC, S, MLparams=True)
+    ldelta = 0.3 * ones((1, G.shape[1]))
+    assert_allclose(r, snp_information(UX, UC, S, ldelta)[0])
+    for snp in range(G.shape[1]):
+        UX_ = hstack((UX[:, snp:snp+1], UC))
+        nLL_, beta_, sigg2_ = nLLeval(0.3, UY, UX_, S, MLparams=True)
+        assert_allclose(nLL[snp], nLL_)
+        assert_allclose(beta[snp], beta_, atol=1e-10)
+        assert_allclose(sigg2[snp], sigg2_)
+
+
+def test_train_associations_lowrank():
+    random = RandomState(981)
+    (y, C, _, _) = _data(random)
+    n = y.shape[0]
+    G = random.randn(n, 10) / sqrt(10)
+    X = asarray(random.randint(3, size=(n, 20)), float)
+
+    stats, pvals, ldelta0, sigg20, beta0 = train_associations(
+        X, y[:, None], dot(G, G.T), C=C)
+    stats_, pvals_, ldelta0_, sigg20_, beta0_ = train_associations(
+        X, y[:, None], None, C=C, G=G)
+    assert_allclose(stats, stats_, atol=1e-8)
+    assert_allclose(pvals, pvals_)
+    assert_allclose(ldelta0, ldelta0_)
+    assert_allclose(sigg20, sigg20_)
+    assert_allclose(beta0, beta0_)
+
+
+def test_train_interactX():
+    random = RandomState(981)
+    (y, C, G, K) = _data(random)
+    S, U = eigh(K)
+    E = random.randn(y.shape[0], 2)
+    X = G[:, :6]
+
+    r = train_interactX(X, y[:, None], K, interactants=E,
+                        covariates=C[:, 1:], chunk_size=4)
+    LL0, LL, ldelta0, beta = r[0], r[1], r[3], r[8]
+    for snp in range(X.shape[1]):
+        D0 = hstack((X[:, snp:snp+1], E, C[:, 1:], ones((y.shape[0], 1))))
+        D = hstack((X[:, snp:snp+1] * E, D0))
+        nLL0 = nLLeval(ldelta0[0, snp], dot(U.T, y), dot(U.T, D0), S)
+        nLL, beta_, _ = nLLeval(ldelta0[0, snp], dot(U.T, y), dot(U.T, D), S,
+                                MLparams=True)
+        assert_allclose(LL0[0, snp], -nLL0)
+        assert_allclose(LL[0, snp], -nLL)
+        assert_allclose(beta[0, snp], beta_, atol=1e-10)
+
+
+def test_run_interact():
+    random = RandomState(981)
+    (y, C, G, K) = _data(random)
+    A = G[:, :4]
+    B = G[:, 4:9]
+    y = y + 3 * A[:, 2] * B[:, 1] / A[:, 2].std() / B[:, 1].std()
+    Y = y[:, None]
+
+    lods = run_interact(Y, A, B, C, K, chunk_size=7)
+    assert_equal(lods.shape, (4, 5, 1))
+    assert_equal(lods[..., 0].argmax(), 2 * 5 + 1)
+
+    best, a, b = run_interact(Y, A, B, C, K, chunk_size=7, topk=3)
+    order = lods[..., 0].ravel().argsort()[::-1][:3]
+    assert_allclose(best[0], lods[..., 0].ravel()[order])
+    assert_equal(a[0] * 5 + b[0], order)
+
+def test_collect_metrics():
+    random = RandomState(981)
+    (y, C, G, K) = _data(random)
+
+    calls = []
+    with collect_metrics(lambda *args: calls.append(args)) as metrics:
+        r = train_associations(G, y[:, None], K, C=C)
+    assert_equal(list(metrics.stages.keys()),
+                 ['eigen', 'rotate', 'delta', 'snps'])
+    assert_equal(metrics.stages['eigen']['calls'], 1)
+    assert_equal(metrics.stages['rotate']['calls'], 3)
+    assert_equal(len(calls), sum(s['calls'] for s in
+                                 metrics.stages.values()))
+    assert all(s['seconds'] >= 0 for s in metrics.stages.values())
+
+    with collect_metrics(track_memory=True) as metrics:
+        train_associations(G, y[:, None], K, C=C)
+    assert metrics.stages['rotate']['bytes'] >= G.nbytes
+    # the temporaries of the SNP models are freed before the stage returns
+    assert metrics.stages['snps']['bytes'] >= G.nbytes
+    assert_allclose(train_associations(G, y[:, None], K, C=C)[1], r[1])
+
+def test_cg_solve():
+    random = RandomState(981)
+    (y, C, G, K) = _data(random)
+    B = hstack((y[:, None], C))
+
+    X = cg_solve(lambda V: dot(K, V), B)
+    assert_allclose(X, solve(K, B), rtol=1e-6, atol=1e-8)
+    assert_allclose(cg_solve(lambda V: dot(K, V), y), solve(K, y),
+                    rtol=1e-6, atol=1e-8)
+
+def test_loco_kinships():
+    random = RandomState(981)
+    (_, _, G, _) = _data(random)
+    Gchrom = random.randint(1, 4, size=G.shape[1])
+
+    for (c, K) in loco_kinships(G, Gchrom, chroms=[1, 2, 3, 4],
+                                chunk_size=7):
+        other = G[:, Gchrom != c]
+        assert_allclose(K, dot(other, other.T), atol=1e-12)
+
+def test_interleaved_blocks():
+    random = RandomState(981)
+    (y, C, G, K) = _data(random)
+    y2 = random.randn(y.shape[0])
+    blocks = [G[:, i:i + 10] for i in range(0, G.shape[1], 10)]
+
+    r1 = train_associations_blocks(blocks, y[:, None], K, C=C)
+    r2 = train_associations_blocks(blocks, y2[:, None], K, C=C)
+    for (X, a, b) in zip(blocks, r1, r2):
+        assert_allclose(a[1], train_associations(X, y[:, None], K, C=C)[1])
+        assert_allclose(b[1], train_associations(X, y2[:, None], K, C=C)[1])
+
+    with temp_folder() as folder:
+        r1 = train_associations_resume(folder, blocks, y[:, None], K, C=C)
+        r2 = train_associations_resume(folder, blocks, y2[:, None], K, C=C)
+        for (X, a, b) in zip(blocks, r1, r2):
+            expected = train_associations(X, y[:, None], K, C=C)[1]
+            assert_allclose(a[1], expected)
+            expected = train_associations(X, y2[:, None], K, C=C)[1]
+            assert_allclose(b[1], expected)
+
+if __name__ == '__main__':
+    __import__('pytest').main([__file__, '-s'])
@@ -0,0 +1,59 @@
+from numpy.random import RandomState
+from numpy import (ones, asarray, dot, eye, hstack, delete, arange)
+from numpy.linalg import solve
+from numpy.testing import assert_allclose
+
+from limix_ext.util import gower_factor
+from limix_ext.lmm.cv import loo_predict, kfold_predict
+from limix_ext.lmm.predict import BLUP
+
+
+def _data(random, n=40, p=60):
+    G = random.randint(3, size=(n, p))
+    G = asarray(G, dtype=float)
+    G -= G.mean(axis=0)
+    G /= G.std(axis=0)
+
+    K = dot(G, G.T) / p
+    y = random.multivariate_normal(ones(n), K + eye(n))
+    C = hstack((ones((n, 1)), random.randn(n, 1)))
+    return (y, C, K)
+
+
+def _predict(y, C, K, delta, test):
+    """BLUP of the test samples refitted on the others at a fixed delta."""
+    c = gower_factor(K)
+    train = delete(arange(len(y)), test)
+    V = c * K[train][:, train] + delta * eye(len(train))
+    Ct = C[train]
+    beta = solve(dot(Ct.T, solve(V, Ct)), dot(Ct.T, solve(V, y[train])))
+    res = solve(V, y[train] - dot(Ct, beta))
+    return dot(C[test], beta) + c * dot(K[test][:, train], res)
+
+
+def test_loo_predict():
+    random = RandomState(981)
+    (y, C, K) = _data(random)
+    delta = BLUP(y, C, K).delta
+
+    pred = loo_predict(y, C, K)
+    for i in range(len(y)):
+        assert_allclose(pred[i], _predict(y, C, K, delta, [i]))
+
+
+def test_kfold_predict():
+    random = RandomState(981)
+    (y, C, K) = _data(random)
+    delta = BLUP(y, C, K).delta
+
+    folds = arange(len(y)) % 4
+    pred = kfold_predict(y, C, K, folds)
+    for fold in range(4):
+        test = arange(len(y))[folds == fold]
+        assert_allclose(pred[test], _predict(y, C, K, delta, test))
+
+    assert_allclose(kfold_predict(y, C, K, arange(len(y))),
+                    loo_predict(y, C, K))
+
+if __name__ == '__main__':
+    __import__('pytest').main([__file__, '-s'])
@@ -0,0 +1,43 @@
+from numpy.random import RandomState
+from numpy import (ones, asarray, dot, eye, abs, where, sort)
+from numpy.testing import assert_allclose, assert_equal
+
+from limix_ext.lmm.eqtl import cis_scan
+from limix_ext.lmm.qtl import normal_scan
+
+
+def test_cis_scan():
+    random = RandomState(981)
+    n = 50
+    p = 80
+    q = 12
+
+    G = random.randint(3, size=(n, p))
+    G = asarray(G, dtype=float)
+    G -= G.mean(axis=0)
+    G /= G.std(axis=0)
+
+    K = dot(G, G.T) / p + eye(n)
+    Y = random.randn(n, q)
+    covariates = ones((n, 1))
+
+    snp_pos = random.randint(0, 1000, size=p)
+    snp_chrom = random.randint(1, 3, size=p)
+    pheno_pos = random.randint(0, 1000, size=q)
+    pheno_chrom = random.randint(1, 3, size=q)
+
+    (phenotypes, snps, pvalues) = cis_scan(Y, covariates, G, K, pheno_pos,
+                                           snp_pos, window=150,
+                                           pheno_chrom=pheno_chrom,
+                                           snp_chrom=snp_chrom,
+                                           chunk_size=4)
+    for j in range(q):
+        cis = where((abs(snp_pos - pheno_pos[j]) <= 150) &
+                    (snp_chrom == pheno_chrom[j]))[0]
+        i = where(phenotypes == j)[0]
+        assert_equal(sort(snps[i]), cis)
+        expected = normal_scan(Y[:, j], covariates, G, K)
+        assert_allclose(pvalues[i], expected[snps[i]])
+
+if __name__ == '__main__':
+    __import__('pytest').main([__file__, '-s'])
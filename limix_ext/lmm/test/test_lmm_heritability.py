@@ -2,6 +2,8 @@ import numpy as np
 from numpy.testing import assert_allclose
 
 from limix_ext.lmm.heritability import binomial_estimate
+from limix_ext.lmm.heritability import poisson_estimate
+from limix_ext.lmm.heritability import estimate_null
 
 
 # def test_bernoulli():
@@ -56,3 +58,39 @@ def test_binomial():
 
     h2 = binomial_estimate(y, ntrials, covariate, K)
     assert_allclose(h2, 0.4750208125210601)
+
+
+def test_poisson_matrix():
+    random = np.random.RandomState(981)
+    n = 200
+    p = n+4
+
+    G = random.randint(3, size=(n, p))
+    G = np.asarray(G, dtype=float)
+    G -= G.mean(axis=0)
+    G /= G.std(axis=0)
+    G /= np.sqrt(p)
+
+    K = np.dot(G, G.T)
+    K = 0.5 * K / K.diagonal().mean() + 0.5 * np.eye(n)
+
+    z = random.multivariate_normal(np.zeros(n), K, size=3).T
+    y = random.poisson(np.exp(z))
+    covariate = np.ones((n, 1))
+
+    h2 = poisson_estimate(y, covariate, K)
+    assert h2.shape == (3,)
+    for i in range(3):
+        assert_allclose(h2[i], poisson_estimate(y[:, i], covariate, K))
+
+
+def test_estimate_null_intercept():
+    random = np.random.RandomState(981)
+    n = 100
+    G = random.randn(n, n + 4) / np.sqrt(n + 4)
+    K = np.dot(G, G.T) + np.eye(n)
+    y = random.multivariate_normal(np.ones(n), K)
+
+    expected = estimate_null(y, np.ones((n, 1)), K)
+    for (a, b) in zip(estimate_null(y, None, K), expected):
+        assert_allclose(a, b)
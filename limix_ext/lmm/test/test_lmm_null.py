@@ -0,0 +1,45 @@
+import os
+
+from numpy.random import RandomState
+from numpy import (ones, asarray, dot, eye, float32)
+from numpy.testing import assert_allclose
+
+from limix_ext._path import temp_folder
+from limix_ext.lmm.null import NullModel
+from limix_ext.lmm.qtl import normal_scan
+
+
+def test_null_model():
+    random = RandomState(981)
+    n = 60
+    p = 40
+
+    G = random.randint(3, size=(n, p))
+    G = asarray(G, dtype=float)
+    G -= G.mean(axis=0)
+    G /= G.std(axis=0)
+
+    K = dot(G, G.T) / p + eye(n)
+    y = 0.5 * G[:, 0] + random.randn(n)
+    covariates = ones((n, 1))
+
+    model = NullModel(y, covariates, K)
+    expected = normal_scan(y, covariates, G, K)
+    assert_allclose(model.scan(G[:, :25]), expected[:25])
+    assert_allclose(model.scan(G[:, 25:], chunk_size=4), expected[25:])
+
+    with temp_folder() as folder:
+        filepath = os.path.join(folder, 'null.npz')
+        model.save(filepath)
+        loaded = NullModel.load(filepath)
+    assert_allclose(loaded.scan(G), expected)
+    assert_allclose(loaded.delta, model.delta)
+    assert_allclose(loaded.beta, model.beta)
+
+    model = NullModel(y, covariates, K, dtype=float32, method='score')
+    expected = normal_scan(y, covariates, G, K, dtype=float32,
+                           method='score')
+    assert_allclose(model.scan(G), expected)
+
+if __name__ == '__main__':
+    __import__('pytest').main([__file__, '-s'])
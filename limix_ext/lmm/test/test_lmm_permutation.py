@@ -0,0 +1,58 @@
+from numpy.random import RandomState
+from numpy import (ones, asarray, dot, eye, all)
+from numpy.testing import assert_allclose
+
+from limix_ext.lmm.qtl import normal_scan
+from limix_ext.lmm.permutation import normal_permutation_scan
+from limix_ext.lmm.permutation import threshold
+from limix_ext.lmm._core._permutation import null_batches
+
+
+def _data(random, n=60, p=40):
+    G = random.randint(3, size=(n, p))
+    G = asarray(G, dtype=float)
+    G -= G.mean(axis=0)
+    G /= G.std(axis=0)
+
+    K = dot(G, G.T) / p + eye(n)
+    y = 0.5 * G[:, 0] + random.randn(n)
+    covariates = ones((n, 1))
+    return (y, covariates, G, K)
+
+
+def test_normal_permutation():
+    random = RandomState(981)
+    (y, covariates, G, K) = _data(random)
+
+    pvalues = normal_permutation_scan(y, covariates, G, K, npermutations=7,
+                                      batch_size=3, chunk_size=15,
+                                      random_state=RandomState(5))
+
+    i = 0
+    for (_, size, seed) in null_batches(7, 3, RandomState(5)):
+        random = RandomState(seed)
+        for _ in range(size):
+            perm = random.permutation(y.shape[0])
+            expected = normal_scan(y[perm], covariates, G, K).min()
+            assert_allclose(pvalues[i], expected, rtol=1e-6)
+            i += 1
+
+    blocks = (G[:, j:j + 15] for j in range(0, G.shape[1], 15))
+    streamed = normal_permutation_scan(y, covariates, blocks, K,
+                                       npermutations=7, batch_size=3,
+                                       random_state=RandomState(5))
+    assert_allclose(streamed, pvalues)
+
+
+def test_normal_bootstrap():
+    random = RandomState(981)
+    (y, covariates, G, K) = _data(random)
+
+    pvalues = normal_permutation_scan(y, covariates, G, K, npermutations=50,
+                                      kind='bootstrap', batch_size=20,
+                                      random_state=RandomState(5))
+    assert all((pvalues > 0) & (pvalues <= 1))
+    assert 0 < threshold(pvalues) < 0.05
+
+if __name__ == '__main__':
+    __import__('pytest').main([__file__, '-s'])
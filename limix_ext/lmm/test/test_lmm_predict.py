@@ -0,0 +1,43 @@
+from numpy.random import RandomState
+from numpy import (ones, asarray, dot, eye, hstack)
+from numpy.linalg import solve
+from numpy.testing import assert_allclose
+
+from limix_ext.util import gower_factor
+from limix_ext.lmm.predict import BLUP
+
+
+def test_blup():
+    random = RandomState(981)
+    n = 80
+    m = 20
+    p = 100
+
+    G = random.randint(3, size=(n + m, p))
+    G = asarray(G, dtype=float)
+    G -= G.mean(axis=0)
+    G /= G.std(axis=0)
+
+    K = dot(G, G.T) / p
+    y = random.multivariate_normal(ones(n + m), K + eye(n + m))
+    C = hstack((ones((n + m, 1)), random.randn(n + m, 1)))
+
+    blup = BLUP(y[:n], C[:n], K[:n, :n])
+    mean, var = blup.predict(K[n:, :n], C[n:], K[n:, n:].diagonal())
+
+    c = gower_factor(K[:n, :n])
+    V = c * K[:n, :n] + blup.delta * eye(n)
+    beta = solve(dot(C[:n].T, solve(V, C[:n])), dot(C[:n].T, solve(V, y[:n])))
+    assert_allclose(blup.beta, beta, rtol=1e-6)
+
+    expected = dot(C[n:], beta) + c * dot(K[n:, :n],
+                                          solve(V, y[:n] - dot(C[:n], beta)))
+    assert_allclose(mean, expected)
+    Kx = c * K[n:, :n]
+    expected = (c * K[n:, n:].diagonal() -
+                (Kx * solve(V, Kx.T).T).sum(1) + blup.delta)
+    assert_allclose(var, blup.genetic_variance * expected)
+    assert_allclose(blup.predict(K[n:, :n], C[n:]), mean)
+
+if __name__ == '__main__':
+    __import__('pytest').main([__file__, '-s'])
@@ -1,10 +1,19 @@
+import os
+import pytest
+
 from numpy.random import RandomState
+from numpy import load, savez, zeros, arange, exp, isfinite
+from numpy import log10, corrcoef
 from numpy import (sqrt, ones, asarray, zeros_like, dot, eye)
-from numpy.testing import assert_allclose
+from numpy.testing import assert_allclose, assert_equal
 
+from limix_ext._path import temp_folder
 from limix_ext.lmm.qtl import bernoulli_scan
 from limix_ext.lmm.qtl import binomial_scan
 from limix_ext.lmm.qtl import poisson_scan
+from limix_ext.lmm.qtl import normal_scan
+from limix_ext.lmm.qtl import normal_loco_scan
+from limix_ext.lmm.qtl import normal_multi_scan
 
 def test_bernoulli():
     random = RandomState(981)
@@ -93,5 +102,258 @@ def test_poisson():
                                   0.800757778798, 0.350573357244,
                                   0.499519169745])
 
+def test_normal_chunked():
+    random = RandomState(981)
+    n = 50
+    p = n+4
+
+    M = ones((n, 1)) * 0.4
+    G = random.randint(3, size=(n, p))
+    G = asarray(G, dtype=float)
+    G -= G.mean(axis=0)
+    G /= G.std(axis=0)
+    G /= sqrt(p)
+
+    K = dot(G, G.T)
+    Kg = K / K.diagonal().mean()
+    K = 0.5*Kg + 0.5*eye(n)
+    K = K / K.diagonal().mean()
+
+    y = random.multivariate_normal(M.ravel(), K)
+    covariates = ones((n, 1))
+
+    pvalues = normal_scan(y, covariates, G, K)
+
+    offsets = []
+    def callback(offset, pvals):
+        offsets.append(offset)
+
+    chunked = normal_scan(y, covariates, G, K, chunk_size=10,
+                          callback=callback)
+    assert_allclose(chunked, pvalues)
+    assert_equal(offsets, [0, 10, 20, 30, 40, 50])
+
+    blocks = (G[:, i:i+7] for i in range(0, p, 7))
+    assert_allclose(normal_scan(y, covariates, blocks, K), pvalues)
+
+    parallel = normal_scan(y, covariates, G, K, chunk_size=10, nprocs=2)
+    assert_allclose(parallel, pvalues)
+
+    K0 = K.copy()
+    assert_allclose(normal_scan(y, covariates, G, K, copy=False), pvalues)
+    assert_equal(K, K0)
+
+def test_normal_float32():
+    random = RandomState(981)
+    n = 300
+    p = 500
+
+    G = random.randint(3, size=(n, p))
+    G = asarray(G, dtype=float)
+    G -= G.mean(axis=0)
+    G /= G.std(axis=0)
+
+    K = dot(G, G.T) / p + eye(n)
+    y = 0.5 * G[:, :5].sum(1) + random.randn(n)
+    covariates = ones((n, 1))
+
+    pvalues = normal_scan(y, covariates, G, K)
+    pvalues32 = normal_scan(y, covariates, G, K, dtype='float32')
+    assert pvalues.min() < 1e-5
+    assert_allclose(pvalues32, pvalues, rtol=1e-4)
+
+def test_normal_score():
+    random = RandomState(981)
+    n = 300
+    p = 500
+
+    G = random.randint(3, size=(n, p))
+    G = asarray(G, dtype=float)
+    G -= G.mean(axis=0)
+    G /= G.std(axis=0)
+
+    K = dot(G, G.T) / p + eye(n)
+    y = 0.5 * G[:, :5].sum(1) + random.randn(n)
+    covariates = ones((n, 1))
+
+    pvalues = normal_scan(y, covariates, G, K)
+    scores = normal_scan(y, covariates, G, K, method='score',
+                         score_threshold=1e-3)
+    refit = scores < 1e-3
+    assert refit.sum() > 0
+    assert_allclose(scores[refit], pvalues[refit])
+    assert all(scores >= pvalues - 1e-10)
+
+def test_normal_loco():
+    random = RandomState(981)
+    n = 60
+    p = 90
+
+    G = random.randint(3, size=(n, p))
+    G = asarray(G, dtype=float)
+    G -= G.mean(axis=0)
+    G /= G.std(axis=0)
+    chrom = random.randint(1, 4, size=p)
+
+    y = 0.5 * G[:, :3].sum(1) + random.randn(n)
+    covariates = ones((n, 1))
+
+    pvalues = normal_loco_scan(y, covariates, G, chrom, chunk_size=7,
+                               nprocs=2)
+    for c in range(1, 4):
+        other = G[:, chrom != c]
+        K = dot(other, other.T)
+        expected = normal_scan(y, covariates, G[:, chrom == c], K)
+        assert_allclose(pvalues[chrom == c], expected)
+
+def test_normal_checkpoint():
+    random = RandomState(981)
+    n = 50
+    p = 40
+
+    G = random.randint(3, size=(n, p))
+    G = asarray(G, dtype=float)
+    G -= G.mean(axis=0)
+    G /= G.std(axis=0)
+
+    K = dot(G, G.T) / p + eye(n)
+    y = random.randn(n)
+    covariates = ones((n, 1))
+
+    expected = normal_scan(y, covariates, G, K, chunk_size=10)
+    with temp_folder() as folder:
+        pvalues = normal_scan(y, covariates, G, K, chunk_size=10,
+                              checkpoint=folder)
+        assert_allclose(pvalues, expected)
+
+        (subfolder, ) = os.listdir(folder)
+        subfolder = os.path.join(folder, subfolder)
+        assert_equal(sorted(os.listdir(subfolder)),
+                     ['block%08d.npz' % i for i in range(4)] + ['null.npz'])
+
+        # finished blocks are not recomputed, missing ones are
+        path = os.path.join(subfolder, 'block00000001.npz')
+        with load(path) as f:
+            r = dict(f)
+        r['r1'] = zeros((1, 10))
+        savez(path, **r)
+        os.remove(os.path.join(subfolder, 'block00000002.npz'))
+
+        pvalues = normal_scan(y, covariates, G, K, chunk_size=10,
+                              checkpoint=folder, nprocs=2)
+        assert_allclose(pvalues[10:20], 0)
+        assert_allclose(pvalues[20:], expected[20:])
+
+        # changed blocks are recomputed
+        G[:, 15] = G[:, 0]
+        pvalues = normal_scan(y, covariates, G, K, chunk_size=10,
+                              checkpoint=folder)
+        expected = normal_scan(y, covariates, G, K)
+        assert_allclose(pvalues[10:20], expected[10:20])
+
+def test_normal_output():
+    import pytest
+
+    random = RandomState(981)
+    n = 50
+    p = 40
+
+    G = random.randint(3, size=(n, p))
+    G = asarray(G, dtype=float)
+    G -= G.mean(axis=0)
+    G /= G.std(axis=0)
+
+    K = dot(G, G.T) / p + eye(n)
+    y = 0.5 * G[:, 0] + random.randn(n)
+    covariates = ones((n, 1))
+
+    h5py = pytest.importorskip('h5py')
+    with temp_folder() as folder:
+        filepath = os.path.join(folder, 'scan.h5')
+        pvalues = normal_scan(y, covariates, G, K, chunk_size=15,
+                              output=filepath)
+        with h5py.File(filepath, 'r') as f:
+            r = dict((k, f[k][:]) for k in f.keys())
+
+    assert_equal(r['snp'], arange(p))
+    assert_allclose(r['pvalue'], pvalues)
+    assert_allclose(r['delta'], r['delta'][0])
+    # Wald and likelihood ratio statistics at a fixed delta
+    assert_allclose((r['beta'] / r['se'])**2, n * (exp(r['stat'] / n) - 1))
+
+    pq = pytest.importorskip('pyarrow.parquet')
+    with temp_folder() as folder:
+        filepath = os.path.join(folder, 'scan.parquet')
+        normal_scan(y, covariates, G, K, chunk_size=15, output=filepath)
+        table = pq.read_table(filepath)
+    for name in r:
+        assert_allclose(table.column(name).to_numpy(), r[name])
+
+def test_normal_multi():
+    random = RandomState(981)
+    n = 60
+    p = 40
+
+    G = random.randint(3, size=(n, p))
+    G = asarray(G, dtype=float)
+    G -= G.mean(axis=0)
+    G /= G.std(axis=0)
+
+    K = dot(G, G.T) / p + eye(n)
+    Y = 0.5 * G[:, :6] + random.randn(n, 6)
+    Y[:5, 1] = float('nan')
+    Y[:5, 3] = float('nan')
+    Y[10:12, 4] = float('nan')
+    covariates = ones((n, 1))
+
+    pvalues = normal_multi_scan(Y, covariates, G, K, chunk_size=15)
+    assert_equal(pvalues.shape, (6, p))
+    for j in range(6):
+        ok = isfinite(Y[:, j])
+        expected = normal_scan(Y[ok, j], covariates[ok], G[ok],
+                               K[ok][:, ok])
+        assert_allclose(pvalues[j], expected)
+
+def test_normal_unknown_method():
+    random = RandomState(981)
+    (y, covariates, X) = (random.randn(20), ones((20, 1)), random.randn(20, 5))
+    with pytest.raises(ValueError):
+        normal_scan(y, covariates, X, eye(20), method='wald')
+
+def test_normal_cg():
+    random = RandomState(981)
+    n = 400
+    m = 500
+    p = 100
+
+    G = random.randint(3, size=(n, m))
+    G = asarray(G, dtype=float)
+    G -= G.mean(axis=0)
+    G /= G.std(axis=0)
+
+    X = random.randint(3, size=(n, p))
+    X = asarray(X, dtype=float)
+    X -= X.mean(axis=0)
+    X /= X.std(axis=0)
+
+    y = dot(G, random.randn(m)) / sqrt(m) + random.randn(n)
+    y += 0.3 * X[:, :3].sum(1)
+    covariates = ones((n, 1))
+
+    expected = normal_scan(y, covariates, X, dot(G, G.T) / m)
+    pvalues = normal_scan(y, covariates, X, None, chunk_size=30,
+                          engine='cg', G=G, random_state=5)
+    assert_allclose(log10(pvalues), log10(expected), rtol=0.1, atol=0.2)
+    assert corrcoef(log10(pvalues), log10(expected))[0, 1] > 0.99
+
+    again = normal_scan(y, covariates, X, None, chunk_size=30, engine='cg',
+                        G=G, random_state=5)
+    assert_allclose(again, pvalues)
+
+    with pytest.raises(ValueError):
+        normal_scan(y, covariates, X, None, engine='cg', G=G, output='a.h5')
+    with pytest.raises(ValueError):
+        normal_scan(y, covariates, X, dot(G, G.T) / m, engine='cg', G=G)
+
 if __name__ == '__main__':
     __import__('pytest').main([__file__, '-s'])
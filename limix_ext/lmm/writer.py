@@ -0,0 +1,77 @@
+from __future__ import absolute_import
+from __future__ import division
+
+from collections import OrderedDict
+
+from numpy import asarray
+
+COLUMNS = OrderedDict([('snp', 'int64'), ('beta', 'float64'),
+                       ('se', 'float64'), ('stat', 'float64'),
+                       ('pvalue', 'float64'), ('delta', 'float64')])
+
+
+class HDF5Writer(object):
+    """Appends the scan records to one resizable HDF5 dataset per column.
+
+    Requires ``h5py``.
+    """
+    def __init__(self, filepath):
+        import h5py
+        self._file = h5py.File(filepath, 'w')
+        self._size = 0
+        for (name, dtype) in COLUMNS.items():
+            self._file.create_dataset(name, shape=(0, ), maxshape=(None, ),
+                                      dtype=dtype, chunks=True)
+
+    def write(self, columns):
+        n = len(columns['snp'])
+        for name in COLUMNS:
+            dataset = self._file[name]
+            dataset.resize((self._size + n, ))
+            dataset[self._size:] = columns[name]
+        self._size += n
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetWriter(object):
+    """Appends the scan records to a Parquet file, one row group per block.
+
+    Requires ``pyarrow``.
+    """
+    def __init__(self, filepath):
+        import pyarrow
+        import pyarrow.parquet
+        self._pa = pyarrow
+        fields = [(name, pyarrow.from_numpy_dtype(dtype))
+                  for (name, dtype) in COLUMNS.items()]
+        self._schema = pyarrow.schema(fields)
+        self._writer = pyarrow.parquet.ParquetWriter(filepath, self._schema)
+
+    def write(self, columns):
+        arrays = [self._pa.array(asarray(columns[name], dtype))
+                  for (name, dtype) in COLUMNS.items()]
+        table = self._pa.Table.from_arrays(arrays, schema=self._schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        self._writer.close()
+
+
+def open_writer(filepath):
+    """Opens a writer of scan records chosen by the file extension.
+
+    ``.h5`` and ``.hdf5`` files are written by :class:`HDF5Writer` and
+    ``.parquet`` files by :class:`ParquetWriter`. Every record holds the SNP
+    index, its effect ``beta`` and standard error ``se``, the test statistic
+    ``stat``, its p-value and the ``delta`` of the SNP model (see
+    :func:`limix_ext.lmm.qtl.normal_scan`).
+    """
+    lower = filepath.lower()
+    if lower.endswith('.h5') or lower.endswith('.hdf5'):
+        return HDF5Writer(filepath)
+    if lower.endswith('.parquet'):
+        return ParquetWriter(filepath)
+    raise ValueError("Unknown format of %s; use .h5, .hdf5 or .parquet."
+                     % filepath)
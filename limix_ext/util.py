@@ -5,12 +5,20 @@ from sys import platform as _platform
 from numpy import copyto, empty_like
 
 
+def gower_factor(K):
+    """Scaling factor of the Gower normalization of covariance matrix K.
+
+    It allows applying the normalization lazily, e.g., to the eigenvalues of K.
+    """
+    return (K.shape[0] - 1) / (K.trace() - K.mean(0).sum())
+
+
 def gower_normalization(K, out=None):
     """Perform Gower normalizion on covariance matrix K.
 
     The rescaled covariance matrix has sample variance of 1.
     """
-    c = (K.shape[0] - 1) / (K.trace() - K.mean(0).sum())
+    c = gower_factor(K)
     if out is None:
         return c * K
 
@@ -18,10 +26,10 @@ def gower_normalization(K, out=None):
     out *= c
 
 
-def clone(X):
+def clone(X, dtype=float):
     if X is None:
         return None
-    Y = empty_like(X, dtype=float, order='C')
+    Y = empty_like(X, dtype=dtype, order='C')
     copyto(Y, X)
     return Y
 